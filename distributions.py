@@ -5,7 +5,9 @@
 # (no recursive closures)
 #
 
-import sys, os, traceback
+import sys, os, traceback, time, math, collections
+import hashlib, struct
+import multiprocessing
 import numpy as np
 
 #
@@ -61,6 +63,8 @@ class EIf (Exp):
         v = self._cond.eval(env)
         if v.type != "boolean":
             raise Exception ("Runtime error: condition not a Boolean")
+        if isinstance(v.value,np.ndarray):
+            return eval_masked(v.value,self._then,self._else,env)
         if v.value:
             return self._then.eval(env)
         else:
@@ -138,6 +142,52 @@ class EFunction (Exp):
         return VClosure(self._params,self._body,env)
 
 
+class EMemCall (Exp):
+    # Body of a function made by mem: calls the closure f once for each
+    # distinct list of arguments, and returns the same value afterwards
+    #
+    # the cache belongs to the query run, so every run of a query draws
+    # its own random world
+    #
+    # in a batched run the cache is per particle: an entry records the
+    # particles that have called f, and the others get their own call
+    # when they first come, so that they go through its observes too
+    #
+    # an entry holds on to the arguments, keyed by identity when they are
+    # not plain values, so that their ids are not reused while it exists
+
+    def __init__ (self,f):
+        self._f = f
+
+    def __str__ (self):
+        return "EMemCall({})".format(str(self._f))
+
+    def eval (self,env):
+        f = self._f
+        args = [ v for (_,v) in env[:len(f.params)] ]
+        key = (id(self),tuple(memo_key(v) for v in args))
+        table = memo_table()
+        mask = None if _current_run is None else _current_run.mask
+        if key not in table:
+            table[key] = (self,args,f.body.eval(zip(f.params,args) + f.env),mask)
+            return table[key][2]
+        (_,_,value,called) = table[key]
+        if called is None:
+            return value
+        missing = ~called if mask is None else mask & ~called
+        if not missing.any():
+            return value
+        try:
+            _current_run.mask = missing
+            v = f.body.eval(zip(f.params,args) + f.env)
+        finally:
+            _current_run.mask = mask
+        value = merge_memo(missing,v,value)
+        called = called | missing
+        table[key] = (self,args,value,None if called.all() else called)
+        return value
+
+
 class ERefCell (Exp):
     # this could (should) be turned into a primitive
     # operation.  (WHY?)
@@ -150,7 +200,10 @@ class ERefCell (Exp):
 
     def eval (self,env):
         v = self._initial.eval(env)
-        return VRefCell(v)
+        cell = VRefCell(v)
+        if _current_run is not None:
+            _current_run.new_cell(cell)
+        return cell
 
 class EDo (Exp):
 
@@ -180,8 +233,9 @@ class EWhile (Exp):
         c = self._cond.eval(env)
         if c.type != "boolean":
             raise Exception ("Runtime error: while condition not a Boolean")
-        while c.value:
+        while uniform_truth(c.value):
             self._exp.eval(env)
+            end_iteration(env)
             c = self._cond.eval(env)
             if c.type != "boolean":
                 raise Exception ("Runtime error: while condition not a Boolean")
@@ -252,10 +306,10 @@ class ENormal (Exp):
         mu = self._mu.eval(env)
         sigma = self._sigma.eval(env)
 
-        if(mu.type != "numeric" or sigma.type != "numeric" and p.type != "numeric"):
+        if(mu.type != "numeric" or sigma.type != "numeric"):
             raise Exception ("Cannot create normal distribution from non-numeric values")
 
-        return VDistribution("normal", np.random.normal(mu.value, sigma.value, 1000))
+        return VDistribution("normal", (mu.value, sigma.value))
 
 
 class EFlip (Exp):
@@ -269,10 +323,115 @@ class EFlip (Exp):
     def eval(self, env):
         p = self._p.eval(env)
 
-        if(p.type != "numeric" and p.type != "numeric"):
+        if(p.type != "numeric"):
             raise Exception ("Cannot create a binomial distribution from a non-numeric value")
 
-        return VDistribution("binomial", np.random.binomial(1, p.value/100.0, 1000))
+        return VDistribution("binomial", (p.value/100.0,))
+
+
+class EUniform (Exp):
+
+    def __init__(self, low, high):
+        self._low = low
+        self._high = high
+
+    def __str__(self):
+        return "EUniform({}, {})".format(self._low, self._high)
+
+    def eval(self, env):
+        low = self._low.eval(env)
+        high = self._high.eval(env)
+
+        if(low.type != "numeric" or high.type != "numeric"):
+            raise Exception ("Cannot create uniform distribution from non-numeric values")
+        if np.any(np.asarray(low.value) >= high.value):
+            raise Exception ("Cannot create uniform distribution over an empty interval")
+
+        return VDistribution("uniform", (low.value, high.value))
+
+
+class EDiscreteUniform (Exp):
+
+    def __init__(self, low, high):
+        self._low = low
+        self._high = high
+
+    def __str__(self):
+        return "EDiscreteUniform({}, {})".format(self._low, self._high)
+
+    def eval(self, env):
+        low = self._low.eval(env)
+        high = self._high.eval(env)
+
+        if(low.type != "numeric" or high.type != "numeric"):
+            raise Exception ("Cannot create discrete uniform distribution from non-numeric values")
+        if np.any(np.asarray(low.value) > high.value):
+            raise Exception ("Cannot create discrete uniform distribution over an empty range")
+
+        return VDistribution("discrete-uniform", (np.floor(low.value), np.floor(high.value)))
+
+
+class EPoisson (Exp):
+
+    def __init__(self, rate):
+        self._rate = rate
+
+    def __str__(self):
+        return "EPoisson({})".format(self._rate)
+
+    def eval(self, env):
+        rate = self._rate.eval(env)
+
+        if(rate.type != "numeric"):
+            raise Exception ("Cannot create a Poisson distribution from a non-numeric value")
+        if np.any(np.asarray(rate.value) <= 0):
+            raise Exception ("Cannot create a Poisson distribution with a non-positive rate")
+
+        return VDistribution("poisson", (rate.value,))
+
+
+class EBeta (Exp):
+
+    def __init__(self, alpha, beta):
+        self._alpha = alpha
+        self._beta = beta
+
+    def __str__(self):
+        return "EBeta({}, {})".format(self._alpha, self._beta)
+
+    def eval(self, env):
+        alpha = self._alpha.eval(env)
+        beta = self._beta.eval(env)
+
+        if(alpha.type != "numeric" or beta.type != "numeric"):
+            raise Exception ("Cannot create beta distribution from non-numeric values")
+        if np.any(np.asarray(alpha.value) <= 0) or np.any(np.asarray(beta.value) <= 0):
+            raise Exception ("Cannot create beta distribution with non-positive parameters")
+
+        return VDistribution("beta", (alpha.value, beta.value))
+
+
+class ECategorical (Exp):
+    # distribution over 0 .. n-1, from n weights or from an array of them
+
+    def __init__(self, weights):
+        self._weights = weights
+
+    def __str__(self):
+        return "ECategorical({})".format(", ".join(str(w) for w in self._weights))
+
+    def eval(self, env):
+        weights = [ w.eval(env) for w in self._weights ]
+
+        if len(weights) == 1 and weights[0].type == "array":
+            weights = weights[0].value
+        if any(w.type != "numeric" or np.ndim(w.value) != 0 for w in weights):
+            raise Exception ("Cannot create categorical distribution from non-numeric weights")
+        weights = np.array([ w.value for w in weights ], dtype=np.float64)
+        if np.any(weights < 0) or np.sum(weights) <= 0:
+            raise Exception ("Cannot create categorical distribution without positive weights")
+
+        return VDistribution("categorical", (weights / np.sum(weights),))
 
 
 class ESample (Exp):
@@ -288,33 +447,61 @@ class ESample (Exp):
         dist = self._dist.eval(env)
         x = None if self._x == None else self._x.eval(env)
 
+        if dist.type != "distribution":
+            raise Exception ("Cannot sample from a non-distribution")
+
         if x == None:
-            if dist.distribution == "normal":
-                return VNumeric(dist.value[np.random.randint(0, len(dist.value))])
+            # one variate, or one per particle in a batched query
+            v = draw(dist, self)
 
             if dist.distribution == "binomial":
-                if dist.value[np.random.randint(0, len(dist.value))] == 1:
-                    return VBoolean(True)
-                return VBoolean(False)
+                return VBoolean(v)
+
+            return VNumeric(v)
         else:
-            if dist.distribution == "normal":
+            if dist.distribution != "binomial":
                 if(x.type != "numeric"):
-                    raise Exception ("Cannot get value for a normal distribution with non-numeric value")
+                    raise Exception ("Cannot get value for a {} distribution with non-numeric value".format(dist.distribution))
 
-                sigma = np.std(dist.value)
-                mu = np.mean(dist.value)
-                return VNumeric(1/(sigma * np.sqrt(2 * np.pi)) * np.exp( - (x.value - mu)**2 / (2 * sigma**2)))
+                observe(dist.log_density(x.value))
+                return VNumeric(dist.density(x.value))
 
             if dist.distribution == "binomial":
                 if(x.type != "boolean"):
                     raise Exception ("Cannot get value for a binomial distribution with non-boolean")
 
-                prob = int(sum(dist.value)/float(len(dist.value))*100)
+                observe(dist.log_density(x.value))
+                # percent, like the argument of flip
+                return VNumeric(dist.density(x.value) * 100)
 
-                if(x.value):
-                    return VNumeric(prob)
-                else:
-                    return VNumeric(1 - prob)
+
+class EObserveAll (Exp):
+    # Observes every element of an array of data under a distribution at
+    # once, and returns the total log-likelihood
+
+    def __init__(self, distribution, data):
+        self._dist = distribution
+        self._data = data
+
+    def __str__ (self):
+        return "EObserveAll({}, {})".format(self._dist, self._data)
+
+    def eval(self, env):
+        dist = self._dist.eval(env)
+        data = self._data.eval(env)
+
+        if dist.type != "distribution":
+            raise Exception ("Cannot observe data under a non-distribution")
+        if data.type != "array":
+            raise Exception ("Cannot observe data that is not an array")
+
+        expected = "boolean" if dist.distribution == "binomial" else "numeric"
+        if any(x.type != expected or np.ndim(x.value) != 0 for x in data.value):
+            raise Exception ("Cannot observe data under a {} distribution that is not all {}".format(dist.distribution, expected))
+
+        log_p = dist.log_likelihood(np.array([ x.value for x in data.value ]))
+        observe(log_p)
+        return VNumeric(log_p)
 
 #
 # Values
@@ -332,6 +519,8 @@ class VNumeric (Value):
         self.type = "numeric"
 
     def __str__ (self):
+        if isinstance(self.value,np.ndarray):
+            return "{} (std {}, {} particles)".format(np.mean(self.value),np.std(self.value),len(self.value))
         return str(self.value)
 
     
@@ -343,6 +532,8 @@ class VBoolean (Value):
         self.type = "boolean"
 
     def __str__ (self):
+        if isinstance(self.value,np.ndarray):
+            return "true with probability {} ({} particles)".format(np.mean(self.value),len(self.value))
         return "true" if self.value else "false"
 
     
@@ -439,20 +630,1997 @@ class VArray(Value):
 
 
 class VDistribution (Value):
+    # A distribution is kept as its family and parameters; samples are
+    # only drawn when they are asked for
+    #
+    # query results have no parameters: they are only known through
+    # their samples, weighted by the likelihood of each run
+    #
+    # families and their parameters:
+    #   normal (mu, sigma)          binomial (p,)
+    #   uniform (low, high)         discrete-uniform (low, high), inclusive
+    #   poisson (rate,)             beta (alpha, beta)
+    #   categorical (probabilities,), over 0 .. n-1
+    #
+    # samples are stored compactly: Booleans packed 8 to a byte, numbers
+    # in single precision under #precision 32
 
-    def __init__(self, d_type, array):
+    def __init__(self, d_type, params, samples=None, log_weights=None):
         self.type = "distribution"
         self.distribution = d_type
-        self.value = array
-
-        # if(self.distribution == "binomial"):
-        #     print sum(array)/float(len(array))
-        # else:
-        #     print array
+        # (mu, sigma) for normal, (p,) for binomial, None if sample-only
+        self.params = params
+        self._samples = None
+        self._packed = None
+        self.weights = None if log_weights is None else normalize_log_weights(log_weights)
+        self._cumulative = None
+        self._sorted = None
+        self._table = None
+        self._kde = None
+        self._moments = None
+        # log of the marginal likelihood of the observations, for the
+        # results of engines that estimate it (smc)
+        self.log_evidence = None
+        # results of distribution algebra: the base distributions they are
+        # a function of, and how, as (function, v1, v2) or, for normals,
+        # as a linear form over base normals; None for base distributions
+        self.bases = None
+        self.derivation = None
+        self.linear = None
+        # samples resampled for combinations with n samples, by n
+        self._images = None
+        if d_type == "categorical" and params is not None:
+            # O(1) sampling whatever the number of categories
+            self._alias = alias_table(params[0])
+        if samples is not None:
+            self.store(samples)
+
+    def store(self, samples):
+        samples = np.asarray(samples)
+        self._count = len(samples)
+        if samples.dtype == bool:
+            self._packed = np.packbits(samples)
+        elif SAMPLE_PRECISION == 32:
+            self._samples = samples.astype(np.float32)
+        else:
+            self._samples = samples
+
+    def size(self):
+        if self._packed is None and self._samples is None:
+            return 0
+        return self._count
+
+    def samples(self):
+        if self._packed is not None:
+            return np.unpackbits(self._packed)[:self._count].astype(bool)
+        return self._samples
+
+    def at(self, i):
+        # samples at the indices i, without unpacking the others
+        if self._packed is not None:
+            return (self._packed[i >> 3] >> (7 - (i & 7))) & 1 == 1
+        return self._samples[i]
+
+    def chunk(self, c):
+        # samples in the slice c, read from disk for memory-mapped sets
+        if self._packed is not None:
+            return self.at(np.arange(c.start, c.stop))
+        return self._samples[c]
+
+    def chunk_weights(self, c):
+        if self.weights is None:
+            return np.full(c.stop - c.start, 1.0 / self._count)
+        return self.weights[c]
+
+    def mapped(self):
+        # samples left on disk by load_distribution
+        return isinstance(self._samples, np.memmap)
+
+    def moments(self):
+        # weighted mean and standard deviation of the samples, computed
+        # once for every later observe, a chunk at a time
+        if self._moments is None:
+            n = self._count
+            if self._packed is not None and self.weights is None:
+                mean = np.sum(POPCOUNT[self._packed]) / float(n)
+            else:
+                mean = sum(np.dot(self.chunk_weights(c), self.chunk(c)) for c in chunks(n))
+            std = np.sqrt(sum(np.dot(self.chunk_weights(c), (self.chunk(c) - mean)**2) for c in chunks(n)))
+            self._moments = (mean, std)
+        return self._moments
+
+    @property
+    def value(self):
+        # buffer of samples, drawn the first time it is used; those of a
+        # result of distribution algebra come from the samples of its bases
+        if self.size() == 0:
+            if self.bases is None:
+                self.store(self.sample(sample_budget()))
+            else:
+                self.store(derived_samples(self,combined_size(self.bases)))
+        return self.samples()
+
+    def sample(self, n=None):
+        # a single variate, or an array of n of them, shifted and scaled
+        # from the pre-drawn blocks of the runtime
+        buffers = random_buffers()
+
+        if self.params is None:
+            return self.sample_uniform(buffers.uniforms(n))
+
+        if self.distribution == "normal":
+            (mu, sigma) = self.params
+            return mu + sigma * buffers.normals(n)
+
+        if self.distribution == "binomial":
+            (p,) = self.params
+            return buffers.uniforms(n) < p
+
+        if self.distribution == "beta" and any(np.ndim(x) != 0 for x in self.params):
+            # no table to invert with a parameter per particle: a ratio
+            # of gamma variates instead
+            (alpha, beta) = self.params
+            size = np.broadcast(alpha, beta).shape if n is None else (n,)
+            x = gamma_variates(np.broadcast_to(alpha, size), buffers)
+            y = gamma_variates(np.broadcast_to(beta, size), buffers)
+            return x / (x + y)
+
+        return self.sample_uniform(buffers.uniforms(n))
+
+    def sample_uniform(self, u):
+        # variates from uniforms on [0, 1) through the inverse cdf
+        if self.params is None:
+            if self.weights is None:
+                i = (np.asarray(u) * self._count).astype(int)
+            else:
+                if self._cumulative is None:
+                    self._cumulative = np.cumsum(self.weights)
+                i = np.minimum(np.searchsorted(self._cumulative, u, side="right"), self._count - 1)
+            return self.at(i)
+
+        if self.distribution == "normal":
+            (mu, sigma) = self.params
+            return mu + sigma * normal_quantile(u)
+
+        if self.distribution == "binomial":
+            (p,) = self.params
+            return u < p
+
+        if self.distribution == "uniform":
+            (low, high) = self.params
+            return low + (high - low) * u
+
+        if self.distribution == "discrete-uniform":
+            (low, high) = self.params
+            return low + np.floor((high - low + 1) * u)
+
+        if self.distribution == "categorical":
+            (probability, alias) = self._alias
+            scaled = np.asarray(u) * len(probability)
+            k = scaled.astype(int)
+            return np.where(scaled - k < probability[k], k, alias[k])[()]
+
+        if self.distribution == "poisson":
+            (rate,) = self.params
+            if np.ndim(rate) != 0:
+                return poisson_quantile(u, rate)
+            (support, cumulative) = self.table()
+            i = np.minimum(np.searchsorted(cumulative, u, side="right"), len(support) - 1)
+            return support[i]
+
+        if self.distribution == "beta":
+            (grid, cumulative) = self.table()
+            return np.interp(u, cumulative, grid)
+
+    def table(self):
+        # support and cdf of a poisson, or cdf of a beta on a grid of
+        # [0, 1], for inverting uniforms; needs constant parameters
+        if self._table is None:
+            if any(np.ndim(x) != 0 for x in self.params):
+                raise Exception ("Runtime error: {} with a different parameter per particle needs random sampling".format(self.distribution))
+            if self.distribution == "poisson":
+                (rate,) = self.params
+                support = np.arange(int(rate + 12 * np.sqrt(rate) + 12))
+                log_factorial = np.concatenate(([0.0], np.cumsum(np.log(support[1:]))))
+                cumulative = np.cumsum(np.exp(support * np.log(rate) - rate - log_factorial))
+            else:
+                # midpoints of a grid denser towards the ends, where the
+                # density can be unbounded
+                t = (np.arange(BETA_GRID) + 0.5) / BETA_GRID
+                support = (1 - np.cos(np.pi * t)) / 2
+                cumulative = np.cumsum(self.density(support) * np.pi / 2 * np.sin(np.pi * t))
+            self._table = (support, cumulative / cumulative[-1])
+        return self._table
+
+    def mean(self):
+        if self.params is None:
+            return self.moments()[0]
+        if self.distribution == "normal":
+            return self.params[0]
+        if self.distribution == "binomial":
+            return self.params[0]
+        if self.distribution in ("uniform", "discrete-uniform"):
+            (low, high) = self.params
+            return (low + high) / 2.0
+        if self.distribution == "poisson":
+            return self.params[0]
+        if self.distribution == "beta":
+            (alpha, beta) = self.params
+            return alpha / float(alpha + beta)
+        if self.distribution == "categorical":
+            (probability,) = self.params
+            return np.dot(np.arange(len(probability)), probability)
+
+    def std(self):
+        if self.params is None:
+            return self.moments()[1]
+        if self.distribution == "normal":
+            return self.params[1]
+        if self.distribution == "binomial":
+            (p,) = self.params
+            return np.sqrt(p * (1 - p))
+        if self.distribution == "uniform":
+            (low, high) = self.params
+            return (high - low) / np.sqrt(12)
+        if self.distribution == "discrete-uniform":
+            (low, high) = self.params
+            return np.sqrt(((high - low + 1)**2 - 1) / 12.0)
+        if self.distribution == "poisson":
+            return np.sqrt(self.params[0])
+        if self.distribution == "beta":
+            (alpha, beta) = self.params
+            return np.sqrt(alpha * beta / ((alpha + beta)**2 * (alpha + beta + 1.0)))
+        if self.distribution == "categorical":
+            (probability,) = self.params
+            return np.sqrt(np.dot((np.arange(len(probability)) - self.mean())**2, probability))
+
+    def sorted_index(self):
+        # samples in increasing order with their cumulative weights, built
+        # the first time a cdf or quantile needs them, except for
+        # memory-mapped sets, which are scanned a chunk at a time instead
+        if self._sorted is None:
+            samples = self.samples()
+            order = np.argsort(samples, kind="mergesort")
+            weights = np.full(len(order), 1.0 / len(order)) if self.weights is None else self.weights[order]
+            self._sorted = (samples[order], np.cumsum(weights))
+        return self._sorted
+
+    def cdf(self, x):
+        # probability of a value at most x
+        if self.params is None and self.mapped():
+            return np.vectorize(self.scan_cdf, otypes=[np.float64])(x)
+        if self.params is None:
+            (values, cumulative) = self.sorted_index()
+            i = np.searchsorted(values, x, side="right")
+            return np.where(i > 0, cumulative[np.maximum(i - 1, 0)], 0.0)
+        if self.distribution == "normal":
+            (mu, sigma) = self.params
+            return 0.5 * (1 + np.vectorize(math.erf)((x - mu) / (sigma * np.sqrt(2))))
+        if self.distribution == "binomial":
+            (p,) = self.params
+            return np.where(x < 0, 0.0, np.where(x < 1, 1 - p, 1.0))
+        if self.distribution == "uniform":
+            (low, high) = self.params
+            return np.clip((x - low) / float(high - low), 0.0, 1.0)
+        if self.distribution == "discrete-uniform":
+            (low, high) = self.params
+            return np.clip((np.floor(x) - low + 1) / (high - low + 1), 0.0, 1.0)
+        if self.distribution == "beta":
+            (grid, cumulative) = self.table()
+            return np.interp(x, grid, cumulative, left=0.0, right=1.0)
+        (support, cumulative) = self.discrete_table()
+        i = np.searchsorted(support, x, side="right")
+        return np.where(i > 0, cumulative[np.maximum(i - 1, 0)], 0.0)
+
+    def discrete_table(self):
+        # support and cdf of a poisson or categorical
+        if self.distribution == "poisson":
+            return self.table()
+        (probability,) = self.params
+        return (np.arange(len(probability)), np.cumsum(probability))
+
+    def quantile(self, q):
+        # smallest value whose cdf reaches q
+        if self.params is None and self.mapped():
+            return np.vectorize(self.scan_quantile, otypes=[self._samples.dtype])(q)[()]
+        if self.params is None:
+            (values, cumulative) = self.sorted_index()
+            return values[np.minimum(np.searchsorted(cumulative, q), len(values) - 1)]
+        if self.distribution == "normal":
+            (mu, sigma) = self.params
+            return mu + sigma * normal_quantile(q)
+        if self.distribution == "binomial":
+            (p,) = self.params
+            return q > 1 - p
+        if self.distribution == "uniform":
+            (low, high) = self.params
+            return low + (high - low) * q
+        if self.distribution == "discrete-uniform":
+            (low, high) = self.params
+            return np.clip(low + np.ceil((high - low + 1) * q) - 1, low, high)
+        if self.distribution == "beta":
+            (grid, cumulative) = self.table()
+            return np.interp(q, cumulative, grid)
+        (support, cumulative) = self.discrete_table()
+        return support[np.minimum(np.searchsorted(cumulative, q), len(support) - 1)]
+
+    def scan_cdf(self, x):
+        return sum(np.sum(self.chunk_weights(c)[self.chunk(c) <= x]) for c in chunks(self._count))
+
+    def scan_quantile(self, q):
+        # quantile of a memory-mapped set without sorting it: the bin of a
+        # histogram of the samples that holds q is narrowed down until it
+        # holds a chunk of samples at most, which is then sorted
+        n = self._count
+        low = min(np.min(self.chunk(c)) for c in chunks(n))
+        high = max(np.max(self.chunk(c)) for c in chunks(n))
+        (below, closed) = (0.0, True)
+        while low < high:
+            edges = np.linspace(low, high, QUANTILE_BINS + 1)
+            (masses, counts) = (np.zeros(QUANTILE_BINS), np.zeros(QUANTILE_BINS, dtype=np.int64))
+            for c in chunks(n):
+                (x, w) = (self.chunk(c), self.chunk_weights(c))
+                inside = (x >= low) & ((x < high) | closed & (x == high))
+                masses += np.histogram(x[inside], edges, weights=w[inside])[0]
+                counts += np.histogram(x[inside], edges)[0]
+            cumulative = below + np.cumsum(masses)
+            k = min(np.searchsorted(cumulative, q), QUANTILE_BINS - 1)
+            if k > 0:
+                below = cumulative[k - 1]
+            narrower = (edges[k], edges[k + 1]) != (low, high)
+            (low, high, closed) = (edges[k], edges[k + 1], closed and k == QUANTILE_BINS - 1)
+            if counts[k] <= CHUNK_SIZE or not narrower:
+                # (a bin a float wide holds a single value or two)
+                break
+        if low == high:
+            return low
+        (values, weights) = ([], [])
+        for c in chunks(n):
+            (x, w) = (self.chunk(c), self.chunk_weights(c))
+            inside = (x >= low) & ((x < high) | closed & (x == high))
+            values.append(x[inside])
+            weights.append(w[inside])
+        (values, weights) = (np.concatenate(values), np.concatenate(weights))
+        order = np.argsort(values, kind="mergesort")
+        cumulative = below + np.cumsum(weights[order])
+        return values[order][min(np.searchsorted(cumulative, q), len(values) - 1)]
+
+    def effective_size(self):
+        # effective sample size of the weighted samples
+        if self.weights is None:
+            return self._count
+        return 1 / sum(np.dot(self.weights[c], self.weights[c]) for c in chunks(self._count))
+
+    def histogram(self, bins):
+        # summary of the samples on bins fixed-width bins, as one weighted
+        # sample per non-empty bin, at the mean of the samples in the bin
+        n = len(self.value)
+        low = min(np.min(self.chunk(c)) for c in chunks(n))
+        high = max(np.max(self.chunk(c)) for c in chunks(n))
+        (masses, sums) = (np.zeros(bins), np.zeros(bins))
+        for c in chunks(n):
+            (x, w) = (self.chunk(c), self.chunk_weights(c))
+            masses += np.histogram(x, bins, range=(low, high), weights=w)[0]
+            sums += np.histogram(x, bins, range=(low, high), weights=w * x)[0]
+        keep = masses > 0
+        return VDistribution(self.distribution if self.params is None else "empirical",
+                             None, sums[keep] / masses[keep], np.log(masses[keep]))
+
+    def kde(self):
+        # gaussian kernel density estimate of sample-only distributions, on
+        # a grid covering the samples: the weights are binned linearly on
+        # the grid and convolved with the kernel by FFT, once
+        if self._kde is None:
+            n = len(self.value)
+            h = 1.06 * self.std() * self.effective_size()**(-0.2)
+            if not h > 0:
+                h = 1e-6 * max(1.0, abs(self.mean()))
+            (top, bottom) = (max(np.max(self.chunk(c)) for c in chunks(n)), min(np.min(self.chunk(c)) for c in chunks(n)))
+            (low, high) = (bottom - 4 * h, top + 4 * h)
+            size = int(min(KDE_GRID_LIMIT, max(KDE_GRID, (high - low) / (0.25 * h)))) + 1
+            dx = (high - low) / (size - 1)
+
+            binned = np.zeros(size)
+            for c in chunks(n):
+                position = (self.chunk(c) - low) / dx
+                i = np.minimum(position.astype(int), size - 2)
+                f = position - i
+                w = self.chunk_weights(c)
+                binned += np.bincount(i, w * (1 - f), size) + np.bincount(i + 1, w * f, size)
+
+            k = min(size - 1, int(np.ceil(5 * h / dx)))
+            offsets = np.arange(-k, k + 1) * dx
+            kernel = np.exp(- offsets**2 / (2 * h**2)) / (h * np.sqrt(2 * np.pi))
+            length = 2**int(np.ceil(np.log2(size + 2 * k)))
+            density = np.fft.irfft(np.fft.rfft(binned, length) * np.fft.rfft(kernel, length), length)[k:k + size]
+            self._kde = (low, high, bottom, top, h, np.linspace(low, high, size), np.maximum(density, 0))
+        return self._kde
+
+    def log_density(self, x):
+        # closed-form log pdf or log pmf at x; sample-only numbers use
+        # their kernel density estimate
+        if self.distribution == "empirical":
+            (low, high, bottom, top, h, grid, density) = self.kde()
+            x = np.asarray(x, dtype=np.float64)
+            inside = np.log(np.maximum(np.interp(x, grid, density), 1e-300))
+            # past the grid, the kernel of the nearest extreme sample
+            distance = np.maximum(bottom - x, x - top)
+            tail = - np.log(self.effective_size()) - distance**2 / (2 * h**2) - np.log(h * np.sqrt(2 * np.pi))
+            return np.where((low <= x) & (x <= high), inside, tail)[()]
+
+        if self.distribution == "uniform":
+            (low, high) = self.params
+            with np.errstate(divide="ignore"):
+                return np.where((low <= x) & (x <= high), -np.log(high - low), -np.inf)[()]
+
+        if self.distribution == "discrete-uniform":
+            (low, high) = self.params
+            valid = (low <= x) & (x <= high) & (np.floor(x) == x)
+            return np.where(valid, -np.log(high - low + 1), -np.inf)[()]
+
+        if self.distribution == "poisson":
+            (rate,) = self.params
+            k = np.maximum(x, 0)
+            return np.where((x >= 0) & (np.floor(x) == x), k * np.log(rate) - rate - log_gamma(k + 1), -np.inf)[()]
+
+        if self.distribution == "beta":
+            (alpha, beta) = self.params
+            inside = np.clip(x, 1e-300, 1 - 1e-16)
+            log_beta = log_gamma(alpha) + log_gamma(beta) - log_gamma(alpha + beta)
+            return np.where((0 <= x) & (x <= 1),
+                            (alpha - 1) * np.log(inside) + (beta - 1) * np.log(1 - inside) - log_beta,
+                            -np.inf)[()]
+
+        if self.distribution == "categorical":
+            (probability,) = self.params
+            k = np.clip(x, 0, len(probability) - 1).astype(int)
+            with np.errstate(divide="ignore"):
+                return np.where((k == x), np.log(probability[k]), -np.inf)[()]
+
+        if self.distribution == "normal":
+            (mu, sigma) = (self.mean(), self.std())
+            return - (x - mu)**2 / (2 * sigma**2) - np.log(sigma * np.sqrt(2 * np.pi))
+
+        if self.distribution == "binomial":
+            p = self.mean()
+            with np.errstate(divide="ignore"):
+                if isinstance(x, np.ndarray):
+                    return np.where(x, np.log(p), np.log(1 - p))
+                return np.log(p) if x else np.log(1 - p)
+
+    def density(self, x):
+        return np.exp(self.log_density(x))
+
+    def log_likelihood(self, data):
+        # sum of the log densities of an array of data; parameters can be
+        # arrays of particles, each particle getting its own total
+        if self.distribution == "normal":
+            # from the sufficient statistics of the data
+            (mu, sigma) = self.params
+            (n, s1, s2) = (len(data), np.sum(data), np.dot(data, data))
+            return (- (s2 - 2 * mu * s1 + n * mu**2) / (2 * sigma**2)
+                    - n * np.log(sigma * np.sqrt(2 * np.pi)))
+
+        if self.distribution == "binomial":
+            (n, k) = (len(data), np.count_nonzero(data))
+            p = self.mean()
+            with np.errstate(divide="ignore", invalid="ignore"):
+                return np.where(k > 0, k * np.log(p), 0.0) + np.where(n > k, (n - k) * np.log(1 - p), 0.0)
+
+        if self.distribution == "poisson" and np.all(data >= 0) and np.all(np.floor(data) == data):
+            (rate,) = self.params
+            return np.sum(data) * np.log(rate) - len(data) * rate - np.sum(log_gamma(data + 1))
+
+        if self.params is None or all(np.ndim(x) == 0 for x in self.params):
+            return np.sum(self.log_density(data))
+
+        # rows of data against the particles, CHUNK_SIZE values at a time
+        rows = max(1, CHUNK_SIZE // max(np.size(x) for x in self.params))
+        return sum(np.sum(self.log_density(data[c, np.newaxis]), axis=0) for c in chunks(len(data), rows))
 
     def __str__(self):
-        return "<distribution {}>".format(self.distribution)
+        if self.distribution == "binomial":
+            summary = "true with probability {}".format(self.mean())
+        else:
+            summary = "mean {}, std {}".format(self.mean(), self.std())
+        if self.params is None:
+            summary += " ({} samples, effective sample size {})".format(self._count, self.effective_size())
+        if self.log_evidence is not None:
+            summary += ", log evidence {}".format(self.log_evidence)
+        return "<distribution {}: {}>".format(self.distribution, summary)
+
+
+# samples read at a time from memory-mapped sample sets
+CHUNK_SIZE = 2**20
+
+# bins of the histograms that narrow down a quantile of a memory-mapped set
+QUANTILE_BINS = 1024
+
+def chunks (n,size=CHUNK_SIZE):
+    return [ slice(i,min(i + size,n)) for i in range(0,n,size) ]
+
+def save_distribution (d,path):
+    # samples in path (a .npy file), normalized weights and their running
+    # sum next to it in .weights.npy and .cumulative.npy
+    if not path.endswith(".npy"):
+        path += ".npy"
+    base = path[:-len(".npy")]
+    np.save(path,d.value)
+    for (suffix,array) in ((".weights.npy",d.weights),(".cumulative.npy",None if d.weights is None else np.cumsum(d.weights))):
+        if array is not None:
+            np.save(base + suffix,array)
+        elif os.path.exists(base + suffix):
+            os.remove(base + suffix)
+    return path
+
+def load_distribution (path):
+    # sample-only distribution memory-mapped from the files written by
+    # save_distribution: statistics, histograms, kernel density estimates,
+    # cdfs and quantiles scan the samples a chunk at a time, and draws
+    # only read the samples they pick; distribution algebra and save
+    # still read the whole set, as their results hold as many samples
+    if not path.endswith(".npy"):
+        path += ".npy"
+    base = path[:-len(".npy")]
+    if not os.path.exists(path):
+        raise Exception ("Runtime error: no sample set in {}".format(path))
+    samples = np.load(path,mmap_mode="r")
+    if samples.ndim != 1 or len(samples) == 0:
+        raise Exception ("Runtime error: {} does not hold a sample set".format(path))
+    d = VDistribution("binomial" if samples.dtype == bool else "empirical",None)
+    d._samples = samples
+    d._count = len(samples)
+    if os.path.exists(base + ".weights.npy"):
+        d.weights = np.load(base + ".weights.npy",mmap_mode="r")
+        d._cumulative = np.load(base + ".cumulative.npy",mmap_mode="r")
+    return d
+
+# smallest and largest number of points of the grid of a kernel density
+# estimate; in between, four points per bandwidth
+KDE_GRID = 1024
+KDE_GRID_LIMIT = 2**16
+
+# points of the grid beta distributions invert uniforms on
+BETA_GRID = 4096
+
+log_gamma = np.vectorize(math.lgamma, otypes=[np.float64])
+
+def alias_table (probability):
+    # Walker's alias table (Vose's construction): category k is drawn as
+    # k with probability[k], and as alias[k] otherwise
+    n = len(probability)
+    scaled = np.array(probability) * n
+    result = np.ones(n)
+    alias = np.arange(n)
+    small = [ k for k in range(n) if scaled[k] < 1 ]
+    large = [ k for k in range(n) if scaled[k] >= 1 ]
+    while small and large:
+        (s,l) = (small.pop(),large.pop())
+        result[s] = scaled[s]
+        alias[s] = l
+        scaled[l] = scaled[l] + scaled[s] - 1
+        if scaled[l] < 1:
+            small.append(l)
+        else:
+            large.append(l)
+    return (result,alias)
+
+# number of bits set in each byte
+POPCOUNT = np.array([ bin(i).count("1") for i in range(256) ], dtype=np.int64)
+
+def normalize_log_weights (log_weights):
+    # normalized weights from log-weights, with the log-sum-exp trick
+    log_weights = np.ascontiguousarray(log_weights, dtype=np.float64)
+    top = np.max(log_weights)
+    if not np.isfinite(top):
+        raise Exception ("Runtime error: every run of the query is impossible under its observations")
+    w = np.exp(log_weights - top)
+    return w / np.sum(w)
+
+class RandomBuffers (object):
+    # Standard normals and uniforms drawn from rng in blocks of size, and
+    # handed out as slices of the current block
+    #
+    # slices are views: a used block is never written to again, only
+    # replaced by a fresh one, so views handed out earlier stay valid
+    #
+    # blocks start small and double up to size, so a short run with its
+    # own stream does not pay for a full block
+
+    def __init__ (self,rng,size=None):
+        self.rng = rng
+        self.size = BUFFER_SIZE if size is None else size
+        self.blocks = {}
+
+    def normals (self,n=None):
+        return self.take("normal",n)
+
+    def uniforms (self,n=None):
+        return self.take("uniform",n)
+
+    def take (self,kind,n):
+        count = 1 if n is None else n
+        if count > self.size:
+            return self.draw(kind,count)
+        (block,position) = self.blocks.get(kind,(np.empty(0),0))
+        if position + count > len(block):
+            length = min(self.size,max(count,2 * len(block),64))
+            (block,position) = (self.draw(kind,length),0)
+        self.blocks[kind] = (block,position + count)
+        if n is None:
+            return float(block[position])
+        return block[position:position + count]
+
+    def draw (self,kind,n):
+        if kind == "normal":
+            return self.rng.standard_normal(n)
+        return self.rng.uniform(size=n)
+
+
+def normal_quantile (u):
+    # inverse cdf of the standard normal (Acklam's rational approximation,
+    # relative error below 1.2e-9)
+    a = [-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+         1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00]
+    b = [-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+         6.680131188771972e+01, -1.328068155288572e+01]
+    c = [-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+         -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00]
+    d = [7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00,
+         3.754408661907416e+00]
+    u = np.asarray(u, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # tails, using the symmetry of the normal for the upper one
+        q = np.sqrt(-2 * np.log(np.minimum(u, 1 - u)))
+        tail = (((((c[0]*q + c[1])*q + c[2])*q + c[3])*q + c[4])*q + c[5]) / \
+               ((((d[0]*q + d[1])*q + d[2])*q + d[3])*q + 1)
+        tail = np.where(u < 0.5, tail, -tail)
+        q = u - 0.5
+        r = q * q
+        central = (((((a[0]*r + a[1])*r + a[2])*r + a[3])*r + a[4])*r + a[5])*q / \
+                  (((((b[0]*r + b[1])*r + b[2])*r + b[3])*r + b[4])*r + 1)
+    z = np.where(np.abs(u - 0.5) <= 0.47575, central, tail)
+    return z if z.ndim else float(z)
+
+def poisson_quantile (u, rate):
+    # inverse cdf of poissons with a rate per particle, summing their
+    # probabilities from 12 standard deviations below the rates
+    (u, rate) = np.broadcast_arrays(np.asarray(u, dtype=np.float64), np.asarray(rate, dtype=np.float64))
+    low = np.maximum(np.floor(rate - 12 * np.sqrt(rate)), 0)
+    steps = int(np.max(24 * np.sqrt(rate))) + 12
+    cumulative = np.zeros(u.shape)
+    count = np.zeros(u.shape, dtype=np.int64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for j in range(steps):
+            k = low + j
+            cumulative += np.exp(k * np.log(rate) - rate - log_gamma(k + 1))
+            count += cumulative < u
+    return (low + count).astype(np.int64)[()]
+
+def gamma_variates (shape, buffers):
+    # gamma variates of unit scale, one per shape, from the normals and
+    # uniforms of buffers (Marsaglia and Tsang's rejection method; shapes
+    # below 1 are drawn with shape + 1 and scaled by u^(1 / shape))
+    shape = np.asarray(shape, dtype=np.float64)
+    a = np.where(shape < 1, shape + 1, shape)
+    d = a - 1 / 3.0
+    c = 1 / np.sqrt(9 * d)
+    result = np.empty(shape.shape)
+    pending = np.flatnonzero(np.ones(shape.shape, dtype=bool))
+    while len(pending) > 0:
+        x = buffers.normals(len(pending))
+        u = buffers.uniforms(len(pending))
+        v = (1 + c.flat[pending] * x)**3
+        with np.errstate(divide="ignore", invalid="ignore"):
+            accept = (v > 0) & (np.log(u) < x**2 / 2 + d.flat[pending] * (1 - v + np.log(v)))
+        result.flat[pending[accept]] = d.flat[pending[accept]] * v[accept]
+        pending = pending[~accept]
+    small = np.flatnonzero(shape < 1)
+    if len(small) > 0:
+        result.flat[small] *= buffers.uniforms(len(small)) ** (1 / shape.flat[small])
+    return result
+
+
+#
+# Random streams
+#
+# every draw of a query comes from a stream split from the key of the
+# query: the key of a stream is a hash of the key it is split from and
+# of a path naming the stream (its run, its block of particles...), so a
+# run draws the same values whichever worker runs it, and results are
+# the same bit for bit at any number of workers
+#
+# (counter-based generators are not in this NumPy, so keys seed a
+# Mersenne Twister instead)
+
+def split_key (key,*path):
+    digest = hashlib.sha256("/".join(str(x) for x in key + path)).digest()
+    return struct.unpack("<4I",digest[:16])
+
+def key_state (key):
+    return np.random.RandomState(np.array(key,dtype=np.uint32))
+
+
+#
+# Sample sources
+#
+# Where the uniforms behind the variates of a query come from: every
+# draw of a run is a new dimension, and every run (or particle) a new
+# point in it
+
+class SampleSource (object):
+    # uniforms straight from the stream of the run, split from key
+
+    def __init__ (self,key):
+        self.key = key
+        self.start_run(0)
+
+    def start_run (self,i):
+        self.run = i
+        self.dimension = 0
+        self.rng = key_state(split_key(self.key,"run",i))
+
+    def uniforms (self,n):
+        self.dimension += 1
+        return self.rng.uniform(size=n)
+
+
+class HaltonSource (SampleSource):
+    # randomly shifted Halton sequence: dimension k uses the radical
+    # inverse in the k-th prime; dimensions beyond the table are random
+
+    def __init__ (self,key):
+        SampleSource.__init__(self,key)
+        self.shifts = []
+        self.shift_state = key_state(split_key(key,"shifts"))
+
+    def uniforms (self,n):
+        k = self.dimension
+        self.dimension += 1
+        if k >= len(HALTON_PRIMES):
+            return self.rng.uniform(size=n)
+        while len(self.shifts) <= k:
+            self.shifts.append(self.shift_state.uniform())
+        points = self.run + 1 if n is None else self.run + np.arange(1,n + 1)
+        u = (radical_inverse(points,HALTON_PRIMES[k]) + self.shifts[k]) % 1.0
+        return u if n is not None else float(u)
+
+
+class AntitheticSource (SampleSource):
+    # pairs of variates from u and 1 - u: the second half of the
+    # particles mirrors the first, and every odd run the run before it,
+    # both runs of a pair reading the same stream
+
+    def start_run (self,i):
+        SampleSource.start_run(self,i)
+        self.rng = key_state(split_key(self.key,"pair",i // 2))
+
+    def uniforms (self,n):
+        self.dimension += 1
+        if n is not None:
+            u = self.rng.uniform(size=(n + 1) // 2)
+            return np.concatenate([u,1 - u])[:n]
+        u = self.rng.uniform()
+        return 1 - u if self.run % 2 == 1 else u
+
+
+class CommonSource (SampleSource):
+    # common random numbers: draw k of run i reads a stream split from
+    # the key of the shared stream with k and i, so queries compared on
+    # the same stream see the same uniforms at the same draws, whichever
+    # worker runs them
+
+    def uniforms (self,n):
+        k = self.dimension
+        self.dimension += 1
+        return key_state(split_key(self.key,k,self.run)).uniform(size=n)
+
+
+HALTON_PRIMES = [ n for n in range(2,600) if all(n % d for d in range(2,int(n**0.5) + 1)) ]
+
+SOURCES = {"random": SampleSource, "halton": HaltonSource, "antithetic": AntitheticSource}
+
+def make_source (options,key):
+    # None stands for drawing variates from the random state of the run
+    if options["source"] == "random":
+        return None
+    if options["source"] == "crn":
+        # named by the stream (and the seed, if any) rather than split
+        # from the key of the query, which differs between unseeded queries
+        return CommonSource(split_key(("crn",options["stream"],options["seed"])))
+    return SOURCES[options["source"]](split_key(key,"source"))
+
+def radical_inverse (i,base):
+    # van der Corput sequence in base at the integers i
+    i = np.array(i,dtype=np.int64)
+    result = np.zeros(i.shape)
+    f = 1.0 / base
+    while np.any(i > 0):
+        result += f * (i % base)
+        i //= base
+        f /= base
+    return result
+
+
+#
+# Query runtime
+#
+
+# default settings of doquery; each can be overridden per query with
+#   doquery name [(option -> expr) ...];
+# samples is the size of the sample buffers of distributions created by
+# the query, None for the budget of the shell
+QUERY_OPTIONS = {"particles": None, "runs": 1000, "workers": 1, "engine": "auto",
+                 "steps": 1000, "burn": 100, "source": "random", "stream": 0,
+                 "batch": 1000, "tolerance": None, "timeout": None, "limit": None,
+                 "samples": None, "seed": None}
+
+# particles drawn from the same stream; a batched query is evaluated
+# one block at a time, which the workers share out
+PARTICLE_BLOCK = 2**14
+
+# size of the sample buffer of a distribution, set in the shell with
+#   #samples N
+SAMPLE_BUDGET = 1000
+
+# bits of the floats samples are stored in (32 or 64), set in the shell with
+#   #precision N
+SAMPLE_PRECISION = 64
 
+# number of variates drawn at a time into the random buffers
+BUFFER_SIZE = 2**16
+
+# auto enumerates the query when it can, and samples it otherwise
+ENGINES = ["auto", "enumerate", "weighted", "mh", "smc"]
+
+# largest number of possible worlds enumerate will go through
+ENUMERATION_LIMIT = 2**20
+
+# smc resamples when the effective sample size drops below this
+# fraction of the particles
+RESAMPLE_THRESHOLD = 0.5
+
+# a streamed query gives up after this many batches in a row in which
+# every run is impossible under the observations
+IMPOSSIBLE_BATCHES = 10
+
+
+class QueryRun (object):
+    # State of one execution of a query body
+    # with particles = N the body is evaluated once for N particles at
+    # the same time: random values are NumPy arrays with one entry per
+    # particle, and mask selects the particles a conditional branch
+    # currently applies to
+    #
+    # log_weight accumulates the log-likelihood of every observe, and
+    # rng is the random state all the draws of the run come from, through
+    # buffers: runs drawing from the same rng can share them
+    #
+    # memo holds the results of the memoized functions called in the run,
+    # and updated the refs and array elements it updated, which settle
+    # collapses to plain values once a batched run is over
+
+    def __init__ (self,particles=None,rng=np.random,source=None,buffers=None,samples=None):
+        self.particles = particles
+        self.mask = None
+        self.log_weight = 0.0
+        self.rng = rng
+        self.source = source
+        self.buffers = RandomBuffers(rng) if buffers is None else buffers
+        self.samples = samples
+        self.memo = {}
+        self.updated = {}
+
+    def draw (self,dist,site):
+        if self.source is None:
+            return dist.sample(self.particles)
+        return dist.sample_uniform(self.source.uniforms(self.particles))
+
+    def observe (self,log_p):
+        if self.mask is not None:
+            log_p = np.where(self.mask,log_p,0.0)
+        self.log_weight = self.log_weight + log_p
+
+    def end_iteration (self,env):
+        pass
+
+    def before_update (self,target,index=None):
+        # called before a ref (index None) or an array element is updated
+        self.updated[(id(target),index)] = (target,index)
+
+    def settle (self):
+        # particle values left in refs and arrays, which may outlive the
+        # run, are collapsed to the value of the last particle, as the
+        # last of N separate runs would have left them
+        if self.particles is None:
+            return
+        for (target,index) in self.updated.values():
+            if index is None:
+                target.content = last_particle(target.content,self.particles)
+            else:
+                target.value[index] = last_particle(target.value[index],self.particles)
+
+    def emit (self,text):
+        print text
+
+    def new_cell (self,cell):
+        pass
+
+
+class SMCRun (QueryRun):
+    # Batched run that resamples its particles at the end of every loop
+    # iteration that observed something, once the effective sample size
+    # has dropped below RESAMPLE_THRESHOLD
+    #
+    # state carried from one iteration to the next lives in variables, so
+    # resampling only has to reorder the particle arrays reachable from
+    # the environment of the loop; values are never updated in place, so
+    # particles keep sharing whatever the resampling does not touch
+    #
+    # log_evidence sums the log of the mean weight of the particles at
+    # every resampling, which evidence completes with the weights left at
+    # the end: an unbiased estimate of the marginal likelihood
+
+    def __init__ (self,particles,rng=np.random,source=None,samples=None):
+        QueryRun.__init__(self,particles=particles,rng=rng,source=source,samples=samples)
+        self.observed = False
+        self.log_evidence = 0.0
+
+    def observe (self,log_p):
+        QueryRun.observe(self,log_p)
+        self.observed = True
+
+    def end_iteration (self,env):
+        # particles of a masked branch cannot be reordered on their own
+        if not self.observed or self.mask is not None:
+            return
+        self.observed = False
+        log_weights = np.broadcast_to(self.log_weight,(self.particles,))
+        weights = normalize_log_weights(log_weights)
+        if 1 / np.sum(weights**2) >= RESAMPLE_THRESHOLD * self.particles:
+            return
+        top = np.max(log_weights)
+        self.log_evidence += top + np.log(np.mean(np.exp(log_weights - top)))
+        ancestors = systematic_resample(weights,self.rng)
+        seen = set()
+        resample_state(env,ancestors,seen)
+        for key in self.memo:
+            self.memo[key] = resample_value(self.memo[key],ancestors,seen)
+        self.log_weight = 0.0
+
+    def evidence (self):
+        log_weights = np.broadcast_to(self.log_weight,(self.particles,))
+        top = np.max(log_weights)
+        if not np.isfinite(top):
+            return -np.inf
+        return self.log_evidence + top + np.log(np.mean(np.exp(log_weights - top)))
+
+
+def systematic_resample (weights,rng):
+    # ancestor of each particle, from one uniform offset
+    n = len(weights)
+    positions = (rng.uniform() + np.arange(n)) / n
+    return np.minimum(np.searchsorted(np.cumsum(weights),positions),n - 1)
+
+def resample_state (env,ancestors,seen):
+    # reorder the particles of every value reachable from env
+    if id(env) in seen:
+        return
+    seen.add(id(env))
+    for i in range(len(env)):
+        (name,v) = env[i]
+        env[i] = (name,resample_value(v,ancestors,seen))
+
+def resample_value (v,ancestors,seen):
+    if v.type in ("numeric","boolean"):
+        if isinstance(v.value,np.ndarray) and v.value.shape == ancestors.shape:
+            return type(v)(v.value[ancestors])
+        return v
+    if id(v) in seen:
+        return v
+    seen.add(id(v))
+    if v.type == "ref":
+        v.content = resample_value(v.content,ancestors,seen)
+    elif v.type == "array":
+        v.value = [ resample_value(x,ancestors,seen) for x in v.value ]
+    elif v.type == "function":
+        resample_state(v.env,ancestors,seen)
+    return v
+
+
+class NotEnumerable (Exception):
+    pass
+
+
+class ParticleDivergence (Exception):
+    pass
+
+
+class EnumerationRun (QueryRun):
+    # Batched run over every assignment of the flips of a query: particle
+    # i is the world where the k-th flip takes bit k of i, weighted by the
+    # prior probability of those values; all the worlds are evaluated at
+    # once, as one vectorized pass over 2^bits particles
+    #
+    # worlds where a flip is never reached differ only in its bit, and
+    # their weights p and 1 - p sum back to the probability of the world
+    #
+    # a pass may be thrown away (too few bits, or a query that cannot be
+    # enumerated), so its side effects are held back: prints are kept in
+    # output, and the old contents of updated refs and arrays in undo,
+    # until the pass is committed or discarded
+
+    def __init__ (self,bits):
+        QueryRun.__init__(self,particles=2**bits)
+        self.bits = bits
+        self.flips = 0
+        self.output = []
+        self.undo = []
+
+    def before_update (self,target,index=None):
+        QueryRun.before_update(self,target,index)
+        old = target.content if index is None else target.value[index]
+        self.undo.append((target,index,old))
+
+    def emit (self,text):
+        self.output.append(text)
+
+    def commit (self):
+        for text in self.output:
+            print text
+
+    def discard (self):
+        for (target,index,old) in reversed(self.undo):
+            if index is None:
+                target.content = old
+            else:
+                target.value[index] = old
+
+    def draw (self,dist,site):
+        if dist.distribution != "binomial":
+            raise NotEnumerable()
+        k = self.flips
+        self.flips += 1
+        if k >= self.bits:
+            # out of bits: this pass is redone with more of them
+            return np.zeros(self.particles, dtype=bool)
+        b = (np.arange(self.particles) >> k) & 1 == 1
+        p = dist.mean()
+        with np.errstate(divide="ignore"):
+            self.log_weight = self.log_weight + np.where(b,np.log(p),np.log(1 - p))
+        return b
+
+
+class TraceRun (QueryRun):
+    # Run recording its random choices at stable addresses: the k-th
+    # variate drawn by a given sample expression
+    #
+    # choices found in old (the trace of a previous run) are replayed
+    # instead of drawn, so a run only differs from the previous one
+    # where it has to
+    #
+    # the bindings of a query are its segments: each choice records the
+    # segment it was drawn in (None for the body), and segments keeps,
+    # per binding, what run_trace needs to reuse it in a later run
+    # instead of evaluating it again; a binding cannot be reused once
+    # something outside of it may have changed what it computed:
+    #   effects   a ref created outside of the run, or an array, was updated
+    #   dirty     bindings whose refs were updated from outside of them, or
+    #             which printed
+    # cells maps the refs created during the run to their segment
+
+    def __init__ (self,old,rng=np.random,buffers=None,samples=None):
+        QueryRun.__init__(self,rng=rng,buffers=buffers,samples=samples)
+        self.old = old
+        self.choices = {}
+        self.order = []
+        self.visits = {}
+        self.reused = set()
+        self.fresh_log_p = 0.0
+        self.log_prior = 0.0
+        self.segment = None
+        self.segments = []
+        self.cells = {}
+        self.effects = False
+        self.dirty = set()
+
+    def new_cell (self,cell):
+        self.cells[id(cell)] = (cell,self.segment)
+
+    def before_update (self,target,index=None):
+        entry = self.cells.get(id(target)) if index is None else None
+        if entry is None:
+            self.effects = True
+        elif entry[1] != self.segment:
+            self.dirty.add(entry[1])
+
+    def emit (self,text):
+        if self.segment is not None:
+            self.dirty.add(self.segment)
+        print text
+
+    def begin_segment (self,i):
+        self.segment = i
+        self.segment_start = (len(self.order),self.log_weight,self.log_prior,dict(self.visits))
+
+    def end_segment (self,value):
+        # record of the binding just evaluated, None if it cannot be
+        # reused: its value must be a ref to an immutable value, and it
+        # must not have seen or filled memo tables
+        (first,log_weight,log_prior,visits) = self.segment_start
+        addresses = self.order[first:]
+        sites = set(site for (site,_) in addresses)
+        record = None
+        if len(self.memo) == 0 and value.type == "ref" and value.content.type in IMMUTABLE_TYPES:
+            record = (value.content,addresses,self.log_weight - log_weight,self.log_prior - log_prior,
+                      dict((site,visits.get(site,0)) for site in sites),
+                      dict((site,self.visits[site]) for site in sites))
+        self.segments.append(record)
+        self.segment = None
+
+    def reuse_segment (self,previous,i):
+        # a fresh ref to the value of binding i of the previous run, with
+        # its choices and weights, or None if it has to be evaluated
+        record = previous.segments[i]
+        if record is None or previous.effects or self.effects or i in previous.dirty or len(self.memo) > 0:
+            return None
+        (content,addresses,log_weight,log_prior,visits_before,visits_after) = record
+        # the sample expressions it draws from must be at the same count,
+        # or its addresses would not be the ones a new evaluation gives
+        if any(self.visits.get(site,0) != k for (site,k) in visits_before.items()):
+            return None
+        for address in addresses:
+            self.choices[address] = previous.choices[address]
+            self.reused.add(address)
+        self.order.extend(addresses)
+        self.visits.update(visits_after)
+        self.log_weight = self.log_weight + log_weight
+        self.log_prior += log_prior
+        self.segments.append(record)
+        cell = VRefCell(content)
+        self.cells[id(cell)] = (cell,i)
+        return cell
+
+    def draw (self,dist,site):
+        k = self.visits.get(site,0)
+        self.visits[site] = k + 1
+        address = (site,k)
+        if address in self.old and self.old[address][0] == dist.distribution:
+            value = self.old[address][1]
+            log_p = dist.log_density(value)
+            self.reused.add(address)
+        else:
+            value = dist.sample()
+            log_p = dist.log_density(value)
+            self.fresh_log_p += log_p
+        self.choices[address] = (dist.distribution,value,log_p,self.segment)
+        self.order.append(address)
+        self.log_prior += log_p
+        return value
+
+
+# values a reused binding can share with the run it comes from
+IMMUTABLE_TYPES = ("numeric","boolean","string","none","distribution")
+
+_current_run = None
+
+def run_query (query,run):
+    # evaluate the body of a query closure under the given run
+    global _current_run
+    saved = _current_run
+    _current_run = run
+    try:
+        return query.body.eval(query.env)
+    finally:
+        run.settle()
+        _current_run = saved
+
+def last_particle (v,n):
+    # value of the last of the n particles of v
+    if v.type not in ("numeric","boolean") or np.shape(v.value) != (n,):
+        return v
+    value = v.value[-1]
+    if value is np.ma.masked:
+        return VNone()
+    return type(v)(value.item())
+
+def run_trace (query,run,previous=None,changed=None):
+    # run_query for a TraceRun: the bindings of the query are evaluated
+    # one by one, and when run is a proposal made from previous by
+    # resampling the choice at address changed, every binding that did
+    # not draw that choice is taken from previous rather than evaluated
+    # again; only the binding of the changed choice and the body are
+    body = query.body
+    if not isinstance(body,ELet):
+        return run_query(query,run)
+    global _current_run
+    saved = _current_run
+    _current_run = run
+    try:
+        changed_segment = None if changed is None else previous.choices[changed][3]
+        bindings = []
+        for (i,(name,e)) in enumerate(body._bindings):
+            v = None
+            if previous is not None and i != changed_segment:
+                v = run.reuse_segment(previous,i)
+            if v is None:
+                run.begin_segment(i)
+                v = e.eval(query.env)
+                run.end_segment(v)
+            bindings.append((name,v))
+        return body._e2.eval(bindings + query.env)
+    finally:
+        _current_run = saved
+
+def particle_count ():
+    if _current_run is None:
+        return None
+    return _current_run.particles
+
+def draw (dist,site):
+    # a variate of dist for the query run in progress, drawn by the
+    # sample expression site
+    if _current_run is None:
+        return dist.sample()
+    return _current_run.draw(dist,site)
+
+def end_iteration (env):
+    if _current_run is not None:
+        _current_run.end_iteration(env)
+
+# buffers of the draws made outside of queries
+_shell_buffers = RandomBuffers(np.random)
+
+def random_buffers ():
+    if _current_run is None:
+        return _shell_buffers
+    return _current_run.buffers
+
+# results of memoized functions called outside of queries
+_shell_memo = {}
+
+def memo_table ():
+    if _current_run is None:
+        return _shell_memo
+    return _current_run.memo
+
+def sample_budget ():
+    if _current_run is None or _current_run.samples is None:
+        return SAMPLE_BUDGET
+    return _current_run.samples
+
+def observe (log_p):
+    # weight the query run in progress, if any, by an observation
+    if _current_run is not None:
+        _current_run.observe(log_p)
+
+def query_options (options,env):
+    result = dict(QUERY_OPTIONS)
+    for (name,e) in options:
+        if name not in result:
+            raise Exception ("Runtime error: unknown query option {}".format(name))
+        v = e.eval(env)
+        if v.type not in ("numeric","boolean","string"):
+            raise Exception ("Runtime error: query option {} must be a number, Boolean or string".format(name))
+        result[name] = v.value
+    if result["particles"] is not None and result["particles"] < 1:
+        raise Exception ("Runtime error: a query needs at least one particle")
+    if result["runs"] < 1:
+        raise Exception ("Runtime error: a query needs at least one run")
+    if result["workers"] < 1:
+        raise Exception ("Runtime error: a query needs at least one worker")
+    if result["engine"] not in ENGINES:
+        raise Exception ("Runtime error: unknown query engine {}".format(result["engine"]))
+    if result["steps"] < 1 or result["burn"] < 0:
+        raise Exception ("Runtime error: a query needs at least one step")
+    if result["source"] not in SOURCES and result["source"] != "crn":
+        raise Exception ("Runtime error: unknown sample source {}".format(result["source"]))
+    if result["batch"] < 1:
+        raise Exception ("Runtime error: a batch needs at least one run")
+    if result["limit"] is not None and result["limit"] < 1:
+        raise Exception ("Runtime error: a query needs at least one sample")
+    if result["samples"] is not None and result["samples"] < 1:
+        raise Exception ("Runtime error: a sample budget needs at least one sample")
+    if result["seed"] is not None and (result["seed"] < 0 or result["seed"] != int(result["seed"])):
+        raise Exception ("Runtime error: a seed is a non-negative integer")
+    return result
+
+def query_key (options):
+    # key of the streams of a query: from its seed, or from the global
+    # random state when it has none
+    seed = options["seed"] if options["seed"] is not None else np.random.randint(0,2**31 - 1)
+    return split_key(("query",int(seed)))
+
+def infer (query,options):
+    engine = options["engine"]
+    key = query_key(options)
+    if engine == "auto":
+        shortcut = conjugate_posterior(query)
+        if shortcut is not None:
+            (dist,pattern) = shortcut
+            print "conjugate {}: exact posterior, sampling skipped".format(pattern)
+            return dist
+    if engine == "mh":
+        return infer_mh(query,options,key)
+    if engine == "smc":
+        return infer_smc(query,options,key)
+    if engine in ("auto","enumerate"):
+        try:
+            return infer_enumerate(query)
+        except (NotEnumerable,ParticleDivergence):
+            if engine == "enumerate":
+                raise Exception ("Runtime error: query cannot be enumerated")
+        except Exception:
+            # some primitives only take plain values: the sampling
+            # engines evaluate the query one run at a time, and raise
+            # the error again if it is not about particles
+            if engine == "enumerate":
+                raise
+    if options["tolerance"] is not None or options["timeout"] is not None or options["limit"] is not None:
+        return infer_stream(query,options,key)
+    return infer_weighted(query,options,key)
+
+def subexpressions (e):
+    # the expressions directly inside e
+    def within (v):
+        if isinstance(v,Exp):
+            yield v
+        elif isinstance(v,(list,tuple)):
+            for item in v:
+                for sub in within(item):
+                    yield sub
+    return within(list(vars(e).values()))
+
+def is_constant (e,names):
+    # no random choice, no call and no use of names anywhere in e
+    if isinstance(e,(ESample,ECall,EDoQuery)):
+        return False
+    if isinstance(e,EId) and e._id in names:
+        return False
+    return all(is_constant(sub,names) for sub in subexpressions(e))
+
+def is_deref (e,name):
+    return isinstance(e,EPrimCall) and e._prim is oper_deref and isinstance(e._exps[0],EId) and e._exps[0]._id == name
+
+def conjugate_posterior (query):
+    # exact posterior of queries of the forms
+    #   defquery q [(x -> (sample (normal m s)))] (do (observe (normal x s1) y1) ... x);
+    #   defquery q [(x -> (sample (flip p)))] (do (observe (flip (if x a1 b1)) y1) ... x);
+    # as (distribution, description), or None for any other query
+    body = query.body
+    if not isinstance(body,ELet) or len(body._bindings) != 1:
+        return None
+    (x,cell) = body._bindings[0]
+    if not isinstance(cell,ERefCell) or not isinstance(cell._initial,ESample) or cell._initial._x is not None:
+        return None
+    prior = cell._initial._dist
+    exps = list(body._e2._exps) if isinstance(body._e2,EDo) else [body._e2]
+    if not exps or not is_deref(exps[-1],x):
+        return None
+    observations = exps[:-1]
+    for o in observations:
+        if not isinstance(o,ESample) or o._x is None or not is_constant(o._x,[x]):
+            return None
+
+    def constant (e,v_type):
+        if not is_constant(e,[x]):
+            return None
+        v = e.eval(query.env)
+        if v.type != v_type:
+            raise Exception ("Runtime error: expected a {} value in query".format(v_type))
+        return v.value
+
+    if isinstance(prior,ENormal):
+        (m,s) = (constant(prior._mu,"numeric"),constant(prior._sigma,"numeric"))
+        if m is None or s is None:
+            return None
+        precision = 1.0 / s**2
+        weighted = m / float(s**2)
+        for o in observations:
+            if not isinstance(o._dist,ENormal) or not is_deref(o._dist._mu,x):
+                return None
+            s_i = constant(o._dist._sigma,"numeric")
+            if s_i is None:
+                return None
+            precision += 1.0 / s_i**2
+            weighted += constant(o._x,"numeric") / float(s_i**2)
+        dist = VDistribution("normal",(weighted / precision,1 / np.sqrt(precision)))
+        return (dist,"normal prior with {} normal observations".format(len(observations)))
+
+    if isinstance(prior,EFlip):
+        p = constant(prior._p,"numeric")
+        if p is None:
+            return None
+        # likelihood of the observations when x is true and when x is false
+        (l_true,l_false) = (p / 100.0,1 - p / 100.0)
+        for o in observations:
+            if not isinstance(o._dist,EFlip) or not isinstance(o._dist._p,EIf) or not is_deref(o._dist._p._cond,x):
+                return None
+            (a,b) = (constant(o._dist._p._then,"numeric"),constant(o._dist._p._else,"numeric"))
+            if a is None or b is None:
+                return None
+            y = constant(o._x,"boolean")
+            l_true *= a / 100.0 if y else 1 - a / 100.0
+            l_false *= b / 100.0 if y else 1 - b / 100.0
+        if l_true + l_false == 0:
+            raise Exception ("Runtime error: every run of the query is impossible under its observations")
+        dist = VDistribution("binomial",(l_true / (l_true + l_false),))
+        return (dist,"flip prior with {} Bernoulli observations".format(len(observations)))
+
+    return None
+
+def infer_enumerate (query):
+    # exact distribution of a query whose random choices are all flips
+    # the number of flips is found by redoing the pass with one bit per
+    # flip seen in the previous pass, until no new flip shows up; only the
+    # last pass has its prints and updates take effect
+    bits = 0
+    while True:
+        run = EnumerationRun(bits)
+        try:
+            v = run_query(query,run)
+        except:
+            run.discard()
+            raise
+        if run.flips <= bits:
+            break
+        run.discard()
+        bits = run.flips
+        if 2**bits > ENUMERATION_LIMIT:
+            raise NotEnumerable()
+    run.commit()
+    if v.type not in ("numeric","boolean"):
+        raise Exception ("Runtime error: a query must return numbers or Booleans")
+
+    # add up the worlds giving the same value
+    samples = np.broadcast_to(v.value,(run.particles,))
+    weights = normalize_log_weights(np.broadcast_to(run.log_weight,(run.particles,)))
+    (values,index) = np.unique(samples,return_inverse=True)
+    weights = np.bincount(index,weights=weights)
+    if v.type == "boolean":
+        return VDistribution("binomial",(np.sum(weights[values]),))
+    with np.errstate(divide="ignore"):
+        return posterior(v.type,values,np.log(weights))
+
+def posterior (v_type,samples,log_weights):
+    # weighted samples of the result of a query
+    if v_type == "numeric":
+        return VDistribution("empirical", None, np.array(samples, dtype=np.float64), log_weights)
+    if v_type == "boolean":
+        return VDistribution("binomial", None, np.array(samples, dtype=bool), log_weights)
+    raise Exception ("Runtime error: a query must return numbers or Booleans")
+
+def infer_mh (query,options,key):
+    # single-site Metropolis-Hastings: each step resamples one choice of
+    # the current trace from its prior, replays the others, and accepts
+    # the new trace with the usual lightweight MH ratio; run_trace only
+    # re-evaluates the binding that drew the resampled choice, and the body
+    rng = key_state(split_key(key,"mh"))
+    buffers = RandomBuffers(rng)
+    trace = TraceRun({},rng,buffers,options["samples"])
+    value = run_trace(query,trace)
+    values = []
+    for i in range(options["burn"] + options["steps"]):
+        if trace.order:
+            address = trace.order[rng.randint(len(trace.order))]
+            old = dict(trace.choices)
+            del old[address]
+            proposal = TraceRun(old,rng,buffers,options["samples"])
+            new_value = run_trace(query,proposal,trace,address)
+
+            # choices of the current trace the proposal did not reuse
+            stale = sum(trace.choices[a][2] for a in trace.order if a not in proposal.reused)
+            score = trace.log_weight + trace.log_prior
+            new_score = proposal.log_weight + proposal.log_prior
+            # an impossible trace is left for the first possible proposal,
+            # and an impossible proposal is never accepted
+            if new_score == -np.inf:
+                accept = False
+            elif score == -np.inf:
+                accept = True
+            else:
+                log_alpha = (new_score - score
+                             + np.log(len(trace.order)) - np.log(max(len(proposal.order),1))
+                             + stale - proposal.fresh_log_p)
+                accept = np.log(rng.uniform()) < log_alpha
+            if accept:
+                (trace,value) = (proposal,new_value)
+        # states of the chain before it reaches a possible trace are not
+        # samples of the posterior
+        if i >= options["burn"] and trace.log_weight + trace.log_prior > -np.inf:
+            values.append(value)
+    if not values:
+        raise Exception ("Runtime error: every run of the query is impossible under its observations")
+    if any(v.type != values[0].type for v in values):
+        raise Exception ("Runtime error: runs of a query return different types")
+    return posterior(values[0].type,[ v.value for v in values ],None)
+
+class RunningEstimate (object):
+    # Weighted mean, variance and quantile sketch of a stream of batches
+    # of weighted samples, in constant memory
+    #
+    # weights are kept relative to exp(shift), the largest weight seen so
+    # far; batches are folded into the mean and variance with Welford's
+    # update for merging two sets, and into a t-digest style list of
+    # centroids whose size is bounded by compression
+
+    def __init__ (self,v_type,compression=100):
+        self.type = v_type
+        self.compression = compression
+        self.shift = -np.inf
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.centroids = np.zeros(0)
+        self.centroid_weights = np.zeros(0)
+
+    def add (self,samples,log_weights):
+        samples = np.asarray(samples,dtype=np.float64)
+        log_weights = np.asarray(log_weights,dtype=np.float64)
+        top = np.max(log_weights)
+        if top == -np.inf:
+            self.count += len(samples)
+            return
+        if top > self.shift:
+            scale = np.exp(self.shift - top)
+            self.total *= scale
+            self.total_sq *= scale**2
+            self.m2 *= scale
+            self.centroid_weights = self.centroid_weights * scale
+            self.shift = top
+        w = np.exp(log_weights - self.shift)
+        w_batch = np.sum(w)
+        if w_batch == 0:
+            self.count += len(samples)
+            return
+        mean_batch = np.sum(w * samples) / w_batch
+        delta = mean_batch - self.mean
+        total = self.total + w_batch
+        self.mean += delta * w_batch / total
+        self.m2 += np.sum(w * (samples - mean_batch)**2) + delta**2 * self.total * w_batch / total
+        self.total = total
+        self.total_sq += np.sum(w**2)
+        self.count += len(samples)
+        if self.type == "numeric":
+            self.compress(np.concatenate([self.centroids,samples]),
+                          np.concatenate([self.centroid_weights,w]))
+
+    def compress (self,means,weights):
+        # merge neighbouring centroids as long as a centroid spans at most
+        # one unit of the scale k(q) = compression / (2 pi) asin(2q - 1),
+        # which keeps centroids small in the tails
+        def limit (q):
+            k = self.compression / (2 * np.pi) * np.arcsin(2 * q - 1) + 1
+            return 1.0 if k >= self.compression / 4.0 else (np.sin(k * 2 * np.pi / self.compression) + 1) / 2
+
+        order = np.argsort(means,kind="mergesort")
+        (means,weights) = (means[order],weights[order])
+        keep = weights > 0
+        (means,weights) = (means[keep],weights[keep])
+        total = np.sum(weights)
+        result = []
+        (m,w) = (means[0],weights[0])
+        before = 0.0
+        q_limit = limit(0.0)
+        for i in range(1,len(means)):
+            if (before + w + weights[i]) / total <= q_limit:
+                w += weights[i]
+                m += (means[i] - m) * weights[i] / w
+            else:
+                result.append((m,w))
+                before += w
+                q_limit = limit(min(before / total,1.0))
+                (m,w) = (means[i],weights[i])
+        result.append((m,w))
+        self.centroids = np.array([ c for (c,_) in result ])
+        self.centroid_weights = np.array([ c for (_,c) in result ])
+
+    def variance (self):
+        return self.m2 / self.total
+
+    def effective_size (self):
+        return self.total**2 / self.total_sq
+
+    def half_width (self):
+        # of the 95% confidence interval of the mean
+        return 1.96 * np.sqrt(self.variance() / self.effective_size())
+
+    def quantile (self,q):
+        cumulative = np.cumsum(self.centroid_weights) - self.centroid_weights / 2
+        return np.interp(q * np.sum(self.centroid_weights),cumulative,self.centroids)
+
+    def distribution (self):
+        if self.type == "boolean":
+            return VDistribution("binomial",(self.mean,))
+        with np.errstate(divide="ignore"):
+            return VDistribution("empirical",None,self.centroids,np.log(self.centroid_weights))
+
+    def __str__ (self):
+        if self.total == 0:
+            return "{} samples, none possible under the observations".format(self.count)
+        if self.type == "boolean":
+            estimate = "true with probability {}".format(self.mean)
+        else:
+            estimate = "mean {}, median {}".format(self.mean,self.quantile(0.5))
+        return "{} samples: {} (95% CI +/- {})".format(self.count,estimate,self.half_width())
+
+
+def stream_query (query,options,key):
+    # generator of the running estimate of a query, updated after every
+    # batch of (batch -> N) runs, or of (particles -> N) particles, until
+    # the 95% CI of the mean is narrower than (tolerance -> e), more
+    # than (timeout -> ms) have passed, or (limit -> N) samples are done,
+    # the last batch being cut short to end at the limit;
+    # it fails after IMPOSSIBLE_BATCHES batches with no possible run, since
+    # the CI of the mean is undefined until a run has some weight
+    if options["particles"] is not None:
+        (method,n) = (weighted_particles,options["particles"])
+    else:
+        (method,n) = (weighted_runs,options["batch"])
+    start = time.time()
+    estimate = None
+    while True:
+        first = 0 if estimate is None else estimate.count
+        m = n if options["limit"] is None else min(n,options["limit"] - first)
+        (v_type,samples,log_weights) = method(query,first,m,key,options)
+        if estimate is None:
+            if v_type not in ("numeric","boolean"):
+                raise Exception ("Runtime error: a query must return numbers or Booleans")
+            estimate = RunningEstimate(v_type)
+        elif v_type != estimate.type:
+            raise Exception ("Runtime error: runs of a query return different types")
+        estimate.add(samples,log_weights)
+        yield estimate
+        if estimate.total == 0 and estimate.count >= IMPOSSIBLE_BATCHES * n:
+            raise Exception ("Runtime error: every run of the query is impossible under its observations")
+        if options["tolerance"] is not None and estimate.total > 0 and estimate.half_width() < options["tolerance"]:
+            return
+        if options["timeout"] is not None and (time.time() - start) * 1000 >= options["timeout"]:
+            return
+        if options["limit"] is not None and estimate.count >= options["limit"]:
+            return
+
+def infer_stream (query,options,key):
+    estimate = None
+    for estimate in stream_query(query,options,key):
+        print estimate
+    if estimate.total == 0:
+        raise Exception ("Runtime error: every run of the query is impossible under its observations")
+    return estimate.distribution()
+
+def infer_smc (query,options,key):
+    # sequential Monte Carlo over a batched pass of the query body
+    n = options["particles"] if options["particles"] is not None else options["runs"]
+    run = SMCRun(n,key_state(split_key(key,"smc")),make_source(options,key),options["samples"])
+    v = run_query(query,run)
+    d = posterior(v.type,np.broadcast_to(v.value,(n,)),np.broadcast_to(run.log_weight,(n,)))
+    d.log_evidence = run.evidence()
+    return d
+
+def weighted_runs (query,first,n,key,options):
+    # likelihood weighting: independent runs of the query body, each
+    # weighted by the likelihood of its observations, and each drawing
+    # from its own stream
+    source = make_source(options,key)
+    values = []
+    log_weights = np.empty(n)
+    for i in range(n):
+        if source is not None:
+            source.start_run(first + i)
+        rng = key_state(split_key(key,"run",first + i))
+        run = QueryRun(rng=rng,source=source,samples=options["samples"])
+        values.append(run_query(query,run))
+        log_weights[i] = run.log_weight
+    if any(v.type != values[0].type for v in values):
+        raise Exception ("Runtime error: runs of a query return different types")
+    return (values[0].type,[ v.value for v in values ],log_weights)
+
+def weighted_particles (query,first,n,key,options):
+    # likelihood weighting over batched passes of the query body, one per
+    # block of PARTICLE_BLOCK particles
+    source = make_source(options,key)
+    (types,samples,log_weights) = ([],[],[])
+    for start in range(first,first + n,PARTICLE_BLOCK):
+        m = min(PARTICLE_BLOCK,first + n - start)
+        if source is not None:
+            source.start_run(start)
+        rng = key_state(split_key(key,"particles",start))
+        run = QueryRun(particles=m,rng=rng,source=source,samples=options["samples"])
+        v = run_query(query,run)
+        types.append(v.type)
+        samples.append(np.broadcast_to(v.value,(m,)))
+        log_weights.append(np.broadcast_to(run.log_weight,(m,)))
+    if any(t != types[0] for t in types):
+        raise Exception ("Runtime error: runs of a query return different types")
+    return (types[0],np.concatenate(samples),np.concatenate(log_weights))
+
+def infer_weighted (query,options,key):
+    if options["particles"] is not None:
+        (method,n) = (weighted_particles,options["particles"])
+    else:
+        (method,n) = (weighted_runs,options["runs"])
+    if options["workers"] > 1:
+        return infer_parallel(query,method,n,options,key)
+    (v_type,samples,log_weights) = method(query,0,n,key,options)
+    return posterior(v_type,samples,log_weights)
+
+
+# query being run by the worker processes of infer_parallel; the pool is
+# forked after it is set, so the workers inherit it without pickling
+_parallel_job = None
+
+def parallel_worker (task):
+    (first,n,key) = task
+    (query,method,options) = _parallel_job
+    (v_type,samples,log_weights) = method(query,first,n,key,options)
+    return (v_type,np.array(samples),np.array(log_weights,dtype=np.float64))
+
+def infer_parallel (query,method,n,options,key):
+    # split the runs (or blocks of particles) of a query over a pool of
+    # processes; every run and block has its own stream, so the results
+    # are those of a single process
+    global _parallel_job
+    unit = PARTICLE_BLOCK if method is weighted_particles else 1
+    units = (n + unit - 1) // unit
+    workers = min(options["workers"],units)
+    counts = [ units // workers + (1 if i < units % workers else 0) for i in range(workers) ]
+    firsts = [ sum(counts[:i]) * unit for i in range(workers) ]
+    counts = [ min(counts[i] * unit,n - firsts[i]) for i in range(workers) ]
+    _parallel_job = (query,method,options)
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(parallel_worker,[ (firsts[i],counts[i],key) for i in range(workers) ])
+    finally:
+        pool.close()
+        pool.join()
+        _parallel_job = None
+    if any(r[0] != results[0][0] for r in results):
+        raise Exception ("Runtime error: runs of a query return different types")
+    return posterior(results[0][0],
+                     np.concatenate([ r[1] for r in results ]),
+                     np.concatenate([ r[2] for r in results ]))
+
+def merge_particles (mask,v1,v2):
+    # pick v1 for the particles in mask and v2 for the others
+    #
+    # a none side stands for particles without a value yet: they are the
+    # masked entries of a NumPy masked array, so a masked update into a
+    # ref holding none only sets the particles of the branch, and the
+    # update of the other branch fills in the rest
+    if v1.type == "none" and v2.type == "none":
+        return VNone()
+    if v1.type == "none":
+        v1 = unset_particles(v2,mask.shape)
+    if v2.type == "none":
+        v2 = unset_particles(v1,mask.shape)
+    if v1.type == v2.type and v1.type in ("numeric","boolean"):
+        values = np.ma.where(mask,v1.value,v2.value)
+        if not np.ma.is_masked(values):
+            values = np.ma.getdata(values)
+        return type(v1)(values)
+    raise ParticleDivergence ("Runtime error: cannot merge particle values of type {} and {}".format(v1.type,v2.type))
+
+def unset_particles (v,shape):
+    # value of the type of v with no particle set
+    if v.type not in ("numeric","boolean"):
+        return v
+    values = np.zeros(shape,dtype=np.asarray(v.value).dtype)
+    return type(v)(np.ma.array(values,mask=True))
+
+def eval_masked (cond,e_then,e_else,env):
+    # conditional whose condition differs between particles: each branch
+    # is evaluated under the mask of the particles that take it, then the
+    # results are merged particle by particle
+    run = _current_run
+    outer = run.mask
+    m_then = cond if outer is None else cond & outer
+    m_else = ~cond if outer is None else ~cond & outer
+    if not m_else.any():
+        return e_then.eval(env)
+    if not m_then.any():
+        return e_else.eval(env)
+    try:
+        run.mask = m_then
+        v_then = e_then.eval(env)
+        run.mask = m_else
+        v_else = e_else.eval(env)
+    finally:
+        run.mask = outer
+    return merge_particles(cond,v_then,v_else)
+
+def uniform_truth (b):
+    # loop conditions must agree across the active particles
+    if not isinstance(b,np.ndarray):
+        return b
+    mask = _current_run.mask
+    if mask is not None:
+        b = b[mask]
+    if b.all():
+        return True
+    if not b.any():
+        return False
+    raise ParticleDivergence ("Runtime error: loop condition differs between particles")
+
+
+class EDoQuery (Exp):
+    # Run a query declared with defquery
+
+    def __init__ (self,name,options):
+        self._name = name
+        self._options = options
+
+    def __str__ (self):
+        return "EDoQuery({},[{}])".format(self._name,",".join([ "({},{})".format(id,str(e)) for (id,e) in self._options ]))
+
+    def eval (self,env):
+        q = EId(self._name).eval(env)
+        if q.type == "ref":
+            q = q.content
+        if q.type != "function" or len(q.params) != 0:
+            raise Exception ("Runtime error: {} is not a query".format(self._name))
+        options = query_options(self._options,env)
+        return infer(q,options)
+
+
+
+#
+# Distribution algebra
+#
+# arithmetic and comparisons on distributions give the distribution of
+# the result: in closed form when the families allow it, otherwise one
+# vectorized operation over the sample buffers of the operands
+#
+# operands are correlated through the base distributions they derive
+# from: the ith sample of a result is a function of the ith samples of
+# its bases, whose samples are independent of one another, so (+ d d) is
+# 2d, (- (+ d 1) d) is 1 and (+ d e) pairs independent samples; a base
+# with fewer or more samples than a combination is resampled once for
+# that number, and a result with another number of samples is derived
+# anew from its bases
+#
+# sums and scalings of normals stay in closed form as linear forms over
+# their base normals, so their variances account for shared terms
+#
+
+def is_random (v):
+    return v.type == "distribution"
+
+def is_normal (v):
+    return is_random(v) and v.distribution == "normal" and v.params is not None
+
+def is_constant_value (v):
+    return v.type == "numeric" and np.ndim(v.value) == 0
+
+def base_set (v):
+    # distributions with samples of their own that v is a function of
+    if not is_random(v):
+        return frozenset()
+    return frozenset([v]) if v.bases is None else v.bases
+
+def sample_count (v):
+    return v.size() or len(v.value)
+
+def combined_size (bases):
+    return max(sample_count(b) for b in bases)
+
+def samples_in (v,n):
+    # samples of an operand, paired index by index with those of the other
+    # operands of a combination with n samples
+    if not is_random(v):
+        return v.value
+    if sample_count(v) == n:
+        return v.value
+    if v._images is None:
+        v._images = {}
+    if n not in v._images:
+        v._images[n] = v.sample(n) if v.bases is None else derived_samples(v,n)
+    return v._images[n]
+
+def derived_samples (v,n):
+    # n samples of a result of distribution algebra, from those of its bases
+    if v.linear is not None:
+        (c,a) = v.linear
+        return c + sum(x * samples_in(b,n) for (b,x) in a.items())
+    (function,v1,v2) = v.derivation
+    return function(samples_in(v1,n),samples_in(v2,n))
+
+def shared_weights (bases,n):
+    # weights of the pairs: the product of the weights of the bases paired
+    # through their own samples, resampled bases being unweighted
+    weights = None
+    for b in bases:
+        if b.weights is not None and sample_count(b) == n:
+            weights = b.weights if weights is None else weights * b.weights
+    return weights
+
+def derived_distribution (d_type,samples,weights,derivation,bases):
+    with np.errstate(divide="ignore"):
+        d = VDistribution(d_type,None,samples,None if weights is None else np.log(weights))
+    d.derivation = derivation
+    d.bases = bases
+    return d
+
+def linear_form (v):
+    # v as c + sum of a X over base normals X, as (c, {X: a}), or None
+    if is_constant_value(v):
+        return (v.value,collections.OrderedDict())
+    if not is_normal(v):
+        return None
+    if v.linear is not None:
+        return v.linear
+    return (0.0,collections.OrderedDict([(v,1.0)]))
+
+def combine_linear (op,f1,f2):
+    (c1,a1) = f1
+    (c2,a2) = f2
+    if op in ("+","-"):
+        sign = 1 if op == "+" else -1
+        a = collections.OrderedDict(a1)
+        for (b,x) in a2.items():
+            a[b] = a.get(b,0.0) + sign * x
+        return (c1 + sign * c2,a)
+    if op == "*":
+        if a1 and a2:
+            # a product of normals is not normal
+            return None
+        (k,(c,a)) = (c1,f2) if not a1 else (c2,f1)
+        return (k * c,collections.OrderedDict((b,k * x) for (b,x) in a.items()))
+    return None
+
+def linear_params (form):
+    # mean and standard deviation of a linear form over base normals
+    (c,a) = form
+    mu = c + sum(x * b.params[0] for (b,x) in a.items())
+    variance = sum((x * b.params[1])**2 for (b,x) in a.items())
+    return (mu,np.sqrt(variance))
+
+def analytic_normal (op,function,v1,v2):
+    # closed form of a linear function of normals, or None
+    (f1,f2) = (linear_form(v1),linear_form(v2))
+    if f1 is None or f2 is None:
+        return None
+    bases = base_set(v1) | base_set(v2)
+    if op in ("+","-","*"):
+        form = combine_linear(op,f1,f2)
+        if form is None:
+            return None
+        d = VDistribution("normal",linear_params(form))
+        d.linear = form
+    elif op in ("<",">"):
+        # P(X < Y) = P(X - Y < 0), certain when X - Y is constant
+        (mu,sigma) = linear_params(combine_linear("-",f1,f2) if op == "<" else combine_linear("-",f2,f1))
+        with np.errstate(divide="ignore",invalid="ignore"):
+            p = np.where(sigma > 0,VDistribution("normal",(mu,sigma)).cdf(0),mu < 0)[()]
+        d = VDistribution("binomial",(p,))
+        d.derivation = (function,v1,v2)
+    else:
+        return None
+    d.bases = bases
+    return d
+
+def distribution_algebra (op,function,v1,v2):
+    # distribution of function(X, Y), for the operator op
+    if not (is_random(v1) or is_constant_value(v1)) or not (is_random(v2) or is_constant_value(v2)):
+        raise Exception ("Runtime error: distributions only combine with distributions and numbers")
+    for v in (v1,v2):
+        if is_random(v) and v.distribution == "binomial" and op != "=":
+            raise Exception ("Runtime error: arithmetic on a boolean distribution")
+    result = analytic_normal(op,function,v1,v2)
+    if result is not None:
+        return result
+    bases = base_set(v1) | base_set(v2)
+    # as many as the bases of either operand
+    n = max(sample_count(v) for v in (v1,v2) if is_random(v))
+    samples = function(samples_in(v1,n),samples_in(v2,n))
+    d_type = "binomial" if samples.dtype == bool else "empirical"
+    if all(not is_random(v) or v.weights is None for v in (v1,v2)):
+        # no base is paired through weighted samples of its own
+        weights = None
+    else:
+        weights = shared_weights(bases,n)
+    return derived_distribution(d_type,samples,weights,(function,v1,v2),bases)
 
 
 # Primitive operations
@@ -460,16 +2628,22 @@ class VDistribution (Value):
 def oper_plus (v1,v2): 
     if v1.type == "numeric" and v2.type == "numeric":
         return VNumeric(v1.value + v2.value)
+    if is_random(v1) or is_random(v2):
+        return distribution_algebra("+",np.add,v1,v2)
     raise Exception ("Runtime error: trying to add non-numbers")
 
 def oper_minus (v1,v2):
     if v1.type == "numeric" and v2.type == "numeric":
         return VNumeric(v1.value - v2.value)
+    if is_random(v1) or is_random(v2):
+        return distribution_algebra("-",np.subtract,v1,v2)
     raise Exception ("Runtime error: trying to subtract non-numbers")
 
 def oper_times (v1,v2):
     if v1.type == "numeric" and v2.type == "numeric":
         return VNumeric(v1.value * v2.value)
+    if is_random(v1) or is_random(v2):
+        return distribution_algebra("*",np.multiply,v1,v2)
     raise Exception ("Runtime error: trying to multiply non-numbers")
 
 def oper_zero (v1):
@@ -479,28 +2653,105 @@ def oper_zero (v1):
 
 def oper_lessthan (v1, v2):
     if v1.type == "numeric" and v2.type == "numeric":
-        if v1.value < v2.value:
-            return VBoolean(True)
-        else:
-            return VBoolean(False)
+        return VBoolean(v1.value < v2.value)
+    if is_random(v1) or is_random(v2):
+        return distribution_algebra("<",np.less,v1,v2)
     raise Exception("Runtime error: trying to compare non-integers")
 
 def oper_greaterthan (v1, v2):
     if v1.type == "numeric" and v2.type == "numeric":
-        if v1.value > v2.value:
-            return VBoolean(True)
-        else:
-            return VBoolean(False)
+        return VBoolean(v1.value > v2.value)
+    if is_random(v1) or is_random(v2):
+        return distribution_algebra(">",np.greater,v1,v2)
     raise Exception("Runtime error: trying to compare non-integers")
 
 def oper_equalto (v1, v2):
     if v1.type == "numeric" and v2.type == "numeric":
-        if v1.value == v2.value:
-            return VBoolean(True)
-        else:
-            return VBoolean(False)
+        return VBoolean(v1.value == v2.value)
+    if is_random(v1) or is_random(v2):
+        return distribution_algebra("=",np.equal,v1,v2)
     raise Exception("Runtime error: trying to compare non-integers")
 
+def oper_mean (v1):
+    if v1.type == "distribution":
+        return VNumeric(v1.mean())
+    raise Exception ("Runtime error: mean of a non-distribution")
+
+def oper_std (v1):
+    if v1.type == "distribution":
+        return VNumeric(v1.std())
+    raise Exception ("Runtime error: std of a non-distribution")
+
+def oper_evidence (v1):
+    if v1.type == "distribution" and v1.log_evidence is not None:
+        return VNumeric(v1.log_evidence)
+    raise Exception ("Runtime error: evidence of a distribution not inferred by smc")
+
+def oper_cdf (v1, v2):
+    if v1.type == "distribution" and v2.type == "numeric":
+        return VNumeric(v1.cdf(v2.value)[()])
+    raise Exception ("Runtime error: cdf needs a distribution and a number")
+
+def oper_quantile (v1, v2):
+    if v1.type == "distribution" and v2.type == "numeric":
+        if not 0 <= v2.value <= 1:
+            raise Exception ("Runtime error: quantile outside of [0, 1]")
+        q = v1.quantile(v2.value)
+        return VBoolean(bool(q)) if v1.distribution == "binomial" else VNumeric(q)
+    raise Exception ("Runtime error: quantile needs a distribution and a number")
+
+def oper_median (v1):
+    return oper_quantile(v1, VNumeric(0.5))
+
+def oper_histogram (v1, v2):
+    if v1.type == "distribution" and v2.type == "numeric":
+        if v2.value < 1:
+            raise Exception ("Runtime error: a histogram needs at least one bin")
+        if v1.distribution == "binomial":
+            # already one bit per sample
+            return v1
+        return v1.histogram(v2.value)
+    raise Exception ("Runtime error: histogram needs a distribution and a number of bins")
+
+def oper_mem (v1):
+    if v1.type == "ref":
+        v1 = v1.content
+    if v1.type == "function":
+        return VClosure(v1.params,EMemCall(v1),[])
+    raise Exception ("Runtime error: mem of a non-function")
+
+def oper_save (v1,v2):
+    if v1.type == "distribution" and v2.type == "string":
+        print "saved {}".format(save_distribution(v1,v2.value))
+        return VNone()
+    raise Exception ("Runtime error: save needs a distribution and a file name")
+
+def oper_load (v1):
+    if v1.type == "string":
+        return load_distribution(v1.value)
+    raise Exception ("Runtime error: load needs a file name")
+
+def memo_key (v):
+    # arguments are the same when their values are; arrays of particles
+    # only when they agree for every particle; mutable values (arrays,
+    # refs) and functions and distributions only when they are the same
+    if v.type in ("numeric","boolean","string"):
+        if isinstance(v.value,np.ndarray):
+            return (v.type,v.value.shape,v.value.tobytes())
+        return (v.type,v.value)
+    if v.type == "none":
+        return (v.type,)
+    return (v.type,id(v))
+
+def merge_memo (missing,v,previous):
+    # result of a memoized function, with the particles in missing taking
+    # the value of their own call; other values cannot differ by particle
+    if v.type in ("numeric","boolean","none") and previous.type in ("numeric","boolean","none"):
+        return merge_particles(missing,v,previous)
+    if v.type == previous.type == "string" and v.value == previous.value:
+        return previous
+    raise ParticleDivergence ("Runtime error: memoized function returns a {} that differs between particles".format(v.type))
+
 def oper_deref (v1):
     if v1.type == "ref":
         return v1.content
@@ -508,31 +2759,88 @@ def oper_deref (v1):
 
 def oper_update (v1,v2):
     if v1.type == "ref":
+        if _current_run is not None:
+            _current_run.before_update(v1)
+            if _current_run.mask is not None:
+                # only update the particles of the branch being evaluated
+                v2 = merge_particles(_current_run.mask,v2,v1.content)
         v1.content = v2
         return VNone()
     raise Exception ("Runtime error: updating a non-reference value")
  
 def oper_print (v1):
-    print v1
+    if _current_run is not None:
+        _current_run.emit(str(v1))
+    else:
+        print v1
     return VNone()
 
 def oper_update_array(v1, i, v2):
     if v1.type == "ref" and v1.content.type == "array":
         if(i.type == "numeric"):
-            if(i.value < len(v1.content.value) and i.value >= 0):
-                v1.content.value[i.value] = v2
-                return VNone()
-            raise Exception ("Runtime error: invalid array index")
+            array = v1.content
+            if _current_run is None:
+                if(i.value < len(array.value) and i.value >= 0):
+                    array.value[i.value] = v2
+                    return VNone()
+                raise Exception ("Runtime error: invalid array index")
+            # the index may differ between particles: each element only
+            # takes v2 for the active particles that index it
+            for (k,selected) in particle_indices(i,len(array.value),"Runtime error: invalid array index"):
+                _current_run.before_update(array,k)
+                if selected is not None:
+                    v2_k = merge_particles(selected,v2,array.value[k])
+                else:
+                    v2_k = v2
+                array.value[k] = v2_k
+            return VNone()
         raise Exception("Runtime error: not a valid index")
     raise Exception ("Runtime error: updating a non-reference value or updating non-array")
 
 def oper_index(obj, index):
     if(obj.content.type == "array" and index.type == "numeric"):
-        if(index.value < len(obj.content.value) and index.value >= 0):
-            return obj.content.value[index.value]
-        raise Exception ("Array index out of bounds")
+        array = obj.content
+        if not isinstance(index.value,np.ndarray):
+            if(index.value < len(array.value) and index.value >= 0):
+                return array.value[index.value]
+            raise Exception ("Array index out of bounds")
+        # element index.value[i] for every particle i
+        result = None
+        for (k,selected) in particle_indices(index,len(array.value),"Array index out of bounds"):
+            if selected is None or result is None:
+                result = array.value[k]
+            else:
+                result = merge_particles(selected,array.value[k],result)
+        return result
     raise Exception ("Trying to find index of non-array")
 
+def particle_indices (index,size,message):
+    # the elements an index refers to in a batched run, each with the
+    # particles it applies to among the active ones, or None when it
+    # applies to all of them; particles outside the mask may hold any
+    # index, as their branch is not taken
+    mask = None if _current_run is None else _current_run.mask
+    values = np.asarray(index.value)
+    if values.ndim == 0 and mask is None:
+        k = values[()]
+        if k < 0 or k >= size:
+            raise Exception (message)
+        return [(int(k),None)]
+    values = np.broadcast_to(values,mask.shape if mask is not None else values.shape)
+    active = values if mask is None else values[mask]
+    if ((active < 0) | (active >= size)).any():
+        raise Exception (message)
+    keys = np.unique(active)
+    if mask is None and len(keys) == 1:
+        return [(int(keys[0]),None)]
+    result = []
+    for k in keys:
+        selected = values == k
+        if mask is not None:
+            selected = selected & mask
+        result.append((int(k),selected))
+    return result
+
 def oper_length(obj):
     if(obj.content.type == "array"):
         return VNumeric(len(obj.content.value))
@@ -596,7 +2904,7 @@ def oper_upper(v1):
 ##
 # cf http://pyparsing.wikispaces.com/
 
-from pyparsing import Word, Literal, ZeroOrMore, OneOrMore, oneOf, Keyword, Forward, alphas, alphanums, NoMatch, Optional, White
+from pyparsing import Word, Literal, ZeroOrMore, OneOrMore, oneOf, Keyword, Forward, alphas, alphanums, NoMatch, Optional, White, Combine
 
 
 def initial_env_imp ():
@@ -638,14 +2946,59 @@ def initial_env_imp ():
                 VRefCell(VClosure(["x","y"],
                                   EPrimCall(oper_equalto,[EId("x"),EId("y")]),
                                   env))))
+    env.insert(0,
+                ("mean",
+                VRefCell(VClosure(["d"],
+                                  EPrimCall(oper_mean,[EId("d")]),
+                                  env))))
+    env.insert(0,
+                ("std",
+                VRefCell(VClosure(["d"],
+                                  EPrimCall(oper_std,[EId("d")]),
+                                  env))))
+    env.insert(0,
+                ("evidence",
+                VRefCell(VClosure(["d"],
+                                  EPrimCall(oper_evidence,[EId("d")]),
+                                  env))))
+    env.insert(0,
+                ("cdf",
+                VRefCell(VClosure(["d","x"],
+                                  EPrimCall(oper_cdf,[EId("d"),EId("x")]),
+                                  env))))
+    env.insert(0,
+                ("quantile",
+                VRefCell(VClosure(["d","q"],
+                                  EPrimCall(oper_quantile,[EId("d"),EId("q")]),
+                                  env))))
+    env.insert(0,
+                ("median",
+                VRefCell(VClosure(["d"],
+                                  EPrimCall(oper_median,[EId("d")]),
+                                  env))))
+    env.insert(0,
+                ("histogram",
+                VRefCell(VClosure(["d","n"],
+                                  EPrimCall(oper_histogram,[EId("d"),EId("n")]),
+                                  env))))
+    env.insert(0,
+                ("load",
+                VRefCell(VClosure(["file"],
+                                  EPrimCall(oper_load,[EId("file")]),
+                                  env))))
+    env.insert(0,
+                ("mem",
+                VRefCell(VClosure(["f"],
+                                  EPrimCall(oper_mem,[EId("f")]),
+                                  env))))
 
     return env
 
 
 
 
-def parse_imp (input):
-    # parse a string into an element of the abstract representation
+def imp_grammar ():
+    # grammar to parse a string into an element of the abstract representation
 
     # Grammar:
     #
@@ -681,7 +3034,8 @@ def parse_imp (input):
     # A name is like an identifier but it does not return an EId...
     pNAME = Word(idChars,idChars+"0123456789")
 
-    pCHARS = oneOf(list(alphas)).leaveWhitespace()
+    # letters, and what file names need
+    pCHARS = oneOf(list(alphanums + "._-/")).leaveWhitespace()
     pCHARS.setParseAction(lambda result: result)
 
     pNAMES = ZeroOrMore(pNAME)
@@ -690,6 +3044,9 @@ def parse_imp (input):
     pINTEGER = Word("0123456789")
     pINTEGER.setParseAction(lambda result: EValue(VNumeric(int(result[0]))))
 
+    pDECIMAL = Combine(Word("0123456789") + "." + Word("0123456789"))
+    pDECIMAL.setParseAction(lambda result: EValue(VNumeric(float(result[0]))))
+
     pBOOLEAN = Keyword("true") | Keyword("false")
     pBOOLEAN.setParseAction(lambda result: EValue(VBoolean(result[0]=="true")))
 
@@ -735,19 +3092,49 @@ def parse_imp (input):
     pFLIP = "(" + Keyword("flip") + pEXPR + ")"
     pFLIP.setParseAction(lambda result: EFlip(result[2]))
 
-    pDISTRIBUTION = (pNORMAL | pFLIP)
+    pUNIFORM = "(" + Keyword("uniform") + pEXPR + pEXPR + ")"
+    pUNIFORM.setParseAction(lambda result: EUniform(result[2], result[3]))
+
+    pDISCRETE_UNIFORM = "(" + Keyword("discrete-uniform") + pEXPR + pEXPR + ")"
+    pDISCRETE_UNIFORM.setParseAction(lambda result: EDiscreteUniform(result[2], result[3]))
+
+    pPOISSON = "(" + Keyword("poisson") + pEXPR + ")"
+    pPOISSON.setParseAction(lambda result: EPoisson(result[2]))
+
+    pBETA = "(" + Keyword("beta") + pEXPR + pEXPR + ")"
+    pBETA.setParseAction(lambda result: EBeta(result[2], result[3]))
+
+    pCATEGORICAL = "(" + Keyword("categorical") + pEXPRS + ")"
+    pCATEGORICAL.setParseAction(lambda result: ECategorical(result[2]))
+
+    pDISTRIBUTION = (pNORMAL | pFLIP | pUNIFORM | pDISCRETE_UNIFORM | pPOISSON | pBETA | pCATEGORICAL)
     pDISTRIBUTION.setParseAction(lambda result: result)
 
-    pSAMPLE_NO_PARAM = "(" + Keyword("sample") + pDISTRIBUTION + ")"
+    pSAMPLE_NO_PARAM = "(" + Keyword("sample") + pEXPR + ")"
     pSAMPLE_NO_PARAM.setParseAction(lambda result: ESample(result[2]))
 
-    pSAMPLE_PARAM = "(" + Keyword("observe") + pDISTRIBUTION + pEXPR + ")"
+    pSAMPLE_PARAM = "(" + Keyword("observe") + pEXPR + pEXPR + ")"
     pSAMPLE_PARAM.setParseAction(lambda result: ESample(result[2], result[3]))
 
-    pSAMPLE = (pSAMPLE_NO_PARAM | pSAMPLE_PARAM)
+    pOBSERVE_ALL = "(" + Keyword("observe-all") + pEXPR + pEXPR + ")"
+    pOBSERVE_ALL.setParseAction(lambda result: EObserveAll(result[2], result[3]))
+
+    pSAMPLE = (pOBSERVE_ALL | pSAMPLE_NO_PARAM | pSAMPLE_PARAM)
     pSAMPLE.setParseAction(lambda result: result)
 
-    pEXPR << (pINTEGER | pBOOLEAN | pSTRING | pIDENTIFIER | pWITH | pIF | pFUN | pARRAY | pDISTRIBUTION | pSAMPLE | pCALL)
+    pOPTION = "(" + pNAME + "->" + pEXPR + ")"
+    pOPTION.setParseAction(lambda result: (result[1], result[3]))
+
+    pOPTIONS = ZeroOrMore(pOPTION)
+    pOPTIONS.setParseAction(lambda result: [result])
+
+    pDO = "(" + Keyword("do") + pEXPRS + ")"
+    pDO.setParseAction(lambda result: EDo(result[2]))
+
+    pQUERY = "(" + Keyword("doquery") + pNAME + pOPTIONS + ")"
+    pQUERY.setParseAction(lambda result: EDoQuery(result[2], result[3]))
+
+    pEXPR << (pDECIMAL | pINTEGER | pBOOLEAN | pSTRING | pIDENTIFIER | pWITH | pIF | pFUN | pARRAY | pDISTRIBUTION | pSAMPLE | pDO | pQUERY | pCALL)
 
     pBINDING = "(" + pNAME + "->" + pEXPR + ")"
     pBINDING.setParseAction(lambda result: (result[1], ERefCell(result[3])))
@@ -788,14 +3175,22 @@ def parse_imp (input):
     pSTMT_PRINT = "print" + pEXPR + ";"
     pSTMT_PRINT.setParseAction(lambda result: EPrimCall(oper_print,[result[1]]));
 
+    pSTMT_SAVE = "save" + pEXPR + pEXPR + ";"
+    pSTMT_SAVE.setParseAction(lambda result: EPrimCall(oper_save,[result[1],result[2]]))
+
     pSTMT_UPDATE = pNAME + "<-" + pEXPR + ";"
     pSTMT_UPDATE.setParseAction(lambda result: EPrimCall(oper_update,[EId(result[0]),result[2]]))
 
     pSTMT_UPDATE_ARRAY = pNAME + "[" + pEXPR + "]" + Keyword("<-") + pEXPR + ";"
     pSTMT_UPDATE_ARRAY.setParseAction(lambda result: EPrimCall(oper_update_array, [EId(result[0]), result[2], result[5]]))
 
-    pSTMT_DO_QUERY = "doquery" + pNAME + ";"
-    pSTMT_DO_QUERY.setParseAction(lambda result: EPrimCall(oper_print, [ECall(EId(result[1]), [])]))
+    pSTMT_DO_QUERY_1 = "doquery" + pNAME + "[" + pOPTIONS + "]" + ";"
+    pSTMT_DO_QUERY_1.setParseAction(lambda result: EPrimCall(oper_print, [EDoQuery(result[1], result[3])]))
+
+    pSTMT_DO_QUERY_2 = "doquery" + pNAME + ";"
+    pSTMT_DO_QUERY_2.setParseAction(lambda result: EPrimCall(oper_print, [EDoQuery(result[1], [])]))
+
+    pSTMT_DO_QUERY = (pSTMT_DO_QUERY_1 | pSTMT_DO_QUERY_2)
 
     pFOR = Keyword("for") + "(" + pDECL_OPT + pEXPR + ";" + pSTMT_UPDATE + ")" + pSTMT
     pFOR.setParseAction(lambda result: EFor(result[2], result[3], result[5], result[7]))
@@ -819,7 +3214,7 @@ def parse_imp (input):
     pSTRING_OPER = pSTRING_OPERS + pEXPR + pEXPRS + ";"
     pSTRING_OPER.setParseAction(lambda result: string_operation(result[0], result[1], result[2]))
 
-    pSTMT << ( pSTRING_OPER | pSTMT_IF_1 | pSTMT_IF_2 | pSTMT_WHILE | pSTMT_PRINT | pSTMT_UPDATE | pSTMT_UPDATE_ARRAY | pSTMT_BLOCK | pFOR | pPROD_CALL | pSTMT_DO_QUERY)
+    pSTMT << ( pSTRING_OPER | pSTMT_IF_1 | pSTMT_IF_2 | pSTMT_WHILE | pSTMT_PRINT | pSTMT_SAVE | pSTMT_UPDATE | pSTMT_UPDATE_ARRAY | pSTMT_BLOCK | pFOR | pPROD_CALL | pSTMT_DO_QUERY)
 
     # can't attach a parse action to pSTMT because of recursion, so let's duplicate the parser
     pTOP_STMT = pSTMT.copy()
@@ -836,10 +3231,24 @@ def parse_imp (input):
 
     pQUIT = Keyword("#quit")
     pQUIT.setParseAction(lambda result: {"result":"quit"})
+
+    pSETTING = (Keyword("#samples") | Keyword("#precision") | Keyword("#seed")) + pINTEGER
+    pSETTING.setParseAction(lambda result: {"result":"setting",
+                                            "name":result[0][1:],
+                                            "value":result[1]})
     
-    pTOP = (pQUIT | pABSTRACT | pTOP_DECL | pTOP_STMT )
+    pTOP = (pQUIT | pSETTING | pABSTRACT | pTOP_DECL | pTOP_STMT )
+
+    return pTOP
+
+_IMP_GRAMMAR = None
 
-    result = pTOP.parseString(input)[0]
+def parse_imp (input):
+    # parse a string into an element of the abstract representation
+    global _IMP_GRAMMAR
+    if _IMP_GRAMMAR is None:
+        _IMP_GRAMMAR = imp_grammar()
+    result = _IMP_GRAMMAR.parseString(input)[0]
     return result    # the first element of the result is the expression
 
 def printR(result):
@@ -869,9 +3278,10 @@ def string_operation(operation, name, exprs):
 def shell_imp ():
     # A simple shell
     # Repeatedly read a line of input, parse it, and evaluate the result
+    global SAMPLE_BUDGET, SAMPLE_PRECISION, _shell_buffers
 
     print "Homework 6 - Imp Language"
-    print "#quit to quit, #abs to see abstract representation"
+    print "#quit to quit, #abs to see abstract representation, #samples N to set the sample budget, #precision 32 for single-precision samples, #seed N to seed the session"
     env = initial_env_imp()
 
         
@@ -892,6 +3302,22 @@ def shell_imp ():
             elif result["result"] == "quit":
                 return
 
+            elif result["result"] == "setting":
+                n = result["value"].eval(env).value
+                if result["name"] == "samples":
+                    if n < 1:
+                        raise Exception ("Runtime error: a sample budget needs at least one sample")
+                    SAMPLE_BUDGET = n
+                if result["name"] == "precision":
+                    if n not in (32,64):
+                        raise Exception ("Runtime error: samples are stored in 32 or 64 bits")
+                    SAMPLE_PRECISION = n
+                if result["name"] == "seed":
+                    # draws outside of queries, and keys of unseeded queries
+                    np.random.seed(n)
+                    _shell_buffers = RandomBuffers(np.random)
+                print "{} {}".format(result["name"],n)
+
             elif result["result"] == "declaration":
                 (name,expr) = result["decl"]
                 v = expr.eval(env)
@@ -906,4 +3332,5 @@ def shell_imp ():
             print(exc_type, fname, exc_tb.tb_lineno)
             traceback.print_exc()
 
-shell_imp()
+if __name__ == "__main__":
+    shell_imp()
@@ -10,7 +10,15 @@
 
 
 import sys
-from pyparsing import Word, Literal,  Keyword, Forward, alphas, alphanums, Empty
+from pyparsing import Word, Literal,  Keyword, Forward, alphas, alphanums, Empty, ParserElement
+
+# entries kept by the packrat cache of the natural grammar
+PACKRAT_CACHE_SIZE = 1024
+
+# alternatives of pBASICEXPR start with the same operand: packrat parsing
+# parses it once; the cache is global to pyparsing, so it is enabled once
+# here, for every grammar built in this process, rather than per grammar
+ParserElement.enablePackrat(cache_size_limit=PACKRAT_CACHE_SIZE)
 
 
 #
@@ -277,8 +285,8 @@ INITIAL_FUN_DICT = {
 # cf http://pyparsing.wikispaces.com/
 
 
-def parse (input):
-    # parse a string into an element of the abstract representation
+def grammar ():
+    # grammar to parse a string into an element of the abstract representation
 
     # Grammar:
     #
@@ -344,7 +352,16 @@ def parse (input):
 
     pEXPR << (pINTEGER | pBOOLEAN | pIDENTIFIER | pIF | pLET | pPLUS | pTIMES | pDEF | pFUNC )
 
-    result = pEXPR.parseString(input)[0]
+    return pEXPR
+
+_GRAMMAR = None
+
+def parse (input):
+    # parse a string into an element of the abstract representation
+    global _GRAMMAR
+    if _GRAMMAR is None:
+        _GRAMMAR = grammar()
+    result = _GRAMMAR.parseString(input)[0]
     return result    # the first element of the result is the expression
 
 # Break out binding functions
@@ -370,8 +387,8 @@ def parseDef(result):
     INITIAL_FUN_DICT[result[2]] = {"params": result[4], "body": result[5]}
     return EBoolean(True)
 
-def parse_natural (input):
-    # parse a natural string into an element of the abstract representation
+def natural_grammar ():
+    # grammar to parse a natural string into an element of the abstract representation
 
     # <expr> ::= <integer>
     #          true
@@ -391,7 +408,6 @@ def parse_natural (input):
     # <expr-seq> ::= <expr> , <expr-seq>
     #              <expr>    
 
-
     idChars = alphas+"_+*-?!=<>"
 
     pIDENTIFIER = Word(idChars, idChars+"0123456789")
@@ -442,37 +458,43 @@ def parse_natural (input):
     pEXPROPR << (pTIMES | pADD | pMINUS | pIF)
 
     pEXPR << (pFUNC | pLET | pBASICEXPR | pEXPROPR)
-    result = pEXPR.parseString(input)[0]
+    return pEXPR
+
+_NATURAL_GRAMMAR = None
+
+def parse_natural (input):
+    # parse a natural string into an element of the abstract representation
+    global _NATURAL_GRAMMAR
+    if _NATURAL_GRAMMAR is None:
+        _NATURAL_GRAMMAR = natural_grammar()
+    result = _NATURAL_GRAMMAR.parseString(input)[0]
     return result    # the first element of the result is the expression
 
 ## natural shell helper functions
 
 def append_left(result):
+    # builds new nodes rather than updating result[1]: with packrat
+    # parsing, result[1] can be a cached node shared with other parses
     if(len(result) == 2):
         if type(result[1]) == ECall:
             if type(result[1]._exps[0]) == ECall:
               return flip_expressions(result[0], result[1])
-            result[1]._exps.append(result[0])
-            return result[1]
+            return ECall(result[1]._name, result[1]._exps + [result[0]])
         if type(result[1]) == EIf:
-            result[1]._cond = result[0] 
-            return result[1]
+            return EIf(result[0], result[1]._then, result[1]._else)
     return result[0]
 
 
 def flip_expressions(inside, outside):
     if outside._name == "*" and outside._exps[0]._name == "+":
-        new_outside = outside._exps.pop(0)
-        exp_temp = new_outside._exps.pop(1)
+        new_outside = outside._exps[0]
+        exp_temp = new_outside._exps[1]
 
-        outside._exps.append(inside)
-        outside._exps.append(exp_temp)
+        outside = ECall(outside._name, outside._exps[1:] + [inside, exp_temp])
 
-        new_outside._exps.append(outside)
-        return new_outside
+        return ECall(new_outside._name, new_outside._exps[:1] + new_outside._exps[2:] + [outside])
     else:
-        outside._exps.append(inside)
-        return outside
+        return ECall(outside._name, outside._exps + [inside])
 
 
 def parseNaturalBinding(result):
@@ -371,8 +371,8 @@ INITIAL_FUN_DICT = {
 # cf http://pyparsing.wikispaces.com/
 
 
-def parse (input):
-    # parse a string into an element of the abstract representation
+def grammar ():
+    # grammar to parse a string into an element of the abstract representation
 
     # Grammar:
     #
@@ -458,7 +458,16 @@ def parse (input):
 
     pTOP = (pDEFUN | pTOPEXPR)
 
-    result = pTOP.parseString(input)[0]
+    return pTOP
+
+_GRAMMAR = None
+
+def parse (input):
+    # parse a string into an element of the abstract representation
+    global _GRAMMAR
+    if _GRAMMAR is None:
+        _GRAMMAR = grammar()
+    result = _GRAMMAR.parseString(input)[0]
     return result    # the first element of the result is the expression
 
 
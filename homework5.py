@@ -317,8 +317,8 @@ from pyparsing import Word, Literal, ZeroOrMore, OneOrMore, Keyword, Forward, al
 def letUnimplementedError ():
     raise Exception ("ERROR: let functionality not implemented yet")
 
-def parse (input):
-    # parse a string into an element of the abstract representation
+def grammar ():
+    # grammar to parse a string into an element of the abstract representation
 
     # Grammar:
     #
@@ -392,7 +392,16 @@ def parse (input):
                                          "body":result[6]})
     pTOP = (pDEFUN | pTOPEXPR)
 
-    result = pTOP.parseString(input)[0]
+    return pTOP
+
+_GRAMMAR = None
+
+def parse (input):
+    # parse a string into an element of the abstract representation
+    global _GRAMMAR
+    if _GRAMMAR is None:
+        _GRAMMAR = grammar()
+    result = _GRAMMAR.parseString(input)[0]
     return result    # the first element of the result is the expression
 
 
@@ -485,8 +494,8 @@ def initial_env_curry ():
     return env
 
 
-def parse_curry (input):
-    # parse a string into an element of the abstract representation
+def curry_grammar ():
+    # grammar to parse a string into an element of the abstract representation
 
     # Grammar:
     #
@@ -555,7 +564,16 @@ def parse_curry (input):
                                          "body":result[6]})
     pTOP = (pDEFUN | pTOPEXPR)
 
-    result = pTOP.parseString(input)[0]
+    return pTOP
+
+_CURRY_GRAMMAR = None
+
+def parse_curry (input):
+    # parse a string into an element of the abstract representation
+    global _CURRY_GRAMMAR
+    if _CURRY_GRAMMAR is None:
+        _CURRY_GRAMMAR = curry_grammar()
+    result = _CURRY_GRAMMAR.parseString(input)[0]
     return result    # the first element of the result is the expression
 
 
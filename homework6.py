@@ -549,8 +549,8 @@ def initial_env_imp ():
 
 
 
-def parse_imp (input):
-    # parse a string into an element of the abstract representation
+def imp_grammar ():
+    # grammar to parse a string into an element of the abstract representation
 
     # Grammar:
     #
@@ -714,7 +714,16 @@ def parse_imp (input):
     
     pTOP = (pQUIT | pABSTRACT | pTOP_DECL | pTOP_STMT )
 
-    result = pTOP.parseString(input)[0]
+    return pTOP
+
+_IMP_GRAMMAR = None
+
+def parse_imp (input):
+    # parse a string into an element of the abstract representation
+    global _IMP_GRAMMAR
+    if _IMP_GRAMMAR is None:
+        _IMP_GRAMMAR = imp_grammar()
+    result = _IMP_GRAMMAR.parseString(input)[0]
     return result    # the first element of the result is the expression
 
 def printR(result):
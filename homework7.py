@@ -7,10 +7,15 @@
 #
 # Remarks: 
 #
+# execute() can keep parsed programs in an on-disk cache; it is off
+# unless HOMEWORK7_AST_CACHE names its directory, or execute is called
+# with cache=True (see AST CACHE below)
+#
 
 
 
-import sys, os, traceback, re
+import sys, os, traceback, re, time
+import hashlib, marshal
 
 #
 # Expressions
@@ -180,6 +185,22 @@ class EFor (Exp):
         e.eval(env)
         return VNone()
 
+class ERefCell (Exp):
+    # allocate a reference cell holding the value of an expression
+
+    def __init__ (self,initialExp):
+        self._initial = initialExp
+
+    def __str__ (self):
+        return "ERefCell({})".format(str(self._initial))
+
+    def eval (self,env):
+        v = self._initial.eval(env)
+        # var x = y; copies the content of y rather than aliasing its cell
+        if v.type == "ref":
+            v = v.content
+        return VRefCell(v)
+
 class EDo (Exp):
 
     def __init__ (self,exps):
@@ -485,6 +506,14 @@ def oper_update_array(v1, i, v2):
 
 # this initial environment works with Q1 when you've completed it
 
+# stable names of the primitives that parsed trees refer to, so that
+# EPrimCall nodes can be written to the AST cache
+PRIMITIVES = dict((prim.__name__, prim) for prim in [
+    oper_plus, oper_minus, oper_times, oper_equal, oper_greater_than,
+    oper_less_than, oper_greater_or_equal, oper_less_or_equal,
+    oper_not_equal, oper_not, oper_zero, oper_index, oper_length, oper_map,
+    oper_update, oper_print, oper_update_array])
+
 def initial_env ():
     env = []
     env.insert(0,
@@ -565,14 +594,26 @@ def initial_env ():
 ##
 # cf http://pyparsing.wikispaces.com/
 
-from pyparsing import Word, Literal, ZeroOrMore, OneOrMore, Keyword, Forward, alphas, alphanums, Optional, MatchFirst, delimitedList, NoMatch
+from pyparsing import Word, Literal, ZeroOrMore, OneOrMore, Keyword, Forward, alphas, alphanums, Optional, MatchFirst, delimitedList, ParserElement, ParseResults, ParseBaseException, StringEnd
+
+# entries kept by the packrat cache of the natural grammar
+PACKRAT_CACHE_SIZE = 1024
+
+# alternatives of pBASICEXPR start with the same operand: packrat parsing
+# parses it once; the cache is global to pyparsing, so it is enabled once
+# here, for every grammar built in this process, rather than per grammar
+ParserElement.enablePackrat(cache_size_limit=PACKRAT_CACHE_SIZE)
 
 
 def letUnimplementedError ():
     raise Exception ("ERROR: let functionality not implemented yet")
 
-def parse_natural (input):
-    # parse a natural string into an element of the abstract representation
+def mkBlock (decls,stmts):
+    bindings = [ (n,ERefCell(expr)) for (n,expr) in decls ]
+    return ELet(bindings,EDo(stmts))
+
+def natural_grammar ():
+    # grammar to parse a natural string into an element of the abstract representation
 
     # <expr> ::= <integer>
     #          true
@@ -594,7 +635,7 @@ def parse_natural (input):
 
     RESERVE_WORDS = ["let"]
 
-    idChars = alphas
+    idChars = alphas + "_"
 
     pIDENTIFIER = ~MatchFirst(map(Keyword, RESERVE_WORDS)) + Word(idChars, idChars+"0123456789")
     pIDENTIFIER.setParseAction(lambda result: EId(str(result[0])))
@@ -700,9 +741,13 @@ def parse_natural (input):
     pDECL_VAR = Keyword("var") + pNAME + "=" + pEXPR + ";"
     pDECL_VAR.setParseAction(lambda result: (result[1],result[3]))
 
-    # hack to get pDECL to match only PDECL_VAR (but still leave room
-    # to add to pDECL later)
-    pDECL = ( pDECL_VAR | NoMatch() )
+    pPARAMS = Optional(delimitedList(pNAME))
+    pPARAMS.setParseAction(lambda result: [result])
+
+    pDECL_DEF = Keyword("def") + pNAME + "(" + pPARAMS + ")" + pSTMT_BLOCK
+    pDECL_DEF.setParseAction(lambda result: (result[1], EFunction(result[3], result[5], name=result[1])))
+
+    pDECL = ( pDECL_VAR | pDECL_DEF )
 
     pDECLS = ZeroOrMore(pDECL)
     pDECLS.setParseAction(lambda result: [result])
@@ -734,10 +779,6 @@ def parse_natural (input):
     pSTMTS = ZeroOrMore(pSTMT)
     pSTMTS.setParseAction(lambda result: [result])
 
-    def mkBlock (decls,stmts):
-        bindings = [ (n,ERefCell(expr)) for (n,expr) in decls ]
-        return ELet(bindings,EDo(stmts))
-        
     pSTMT_BLOCK << "{" + pDECLS + pSTMTS + "}"
     pSTMT_BLOCK.setParseAction(lambda result: mkBlock(result[1],result[2]))
 
@@ -758,20 +799,639 @@ def parse_natural (input):
 
     pTOP = (pTOP_DECL | pTOP_STMT )
 
-    result = pTOP.parseString(input)[0]
+    return pTOP
+
+_NATURAL_GRAMMAR = None
+
+# which parser parse_natural uses: "pyparsing" for natural_grammar,
+# "pratt" for the hand-written parser below
+NATURAL_PARSER = "pyparsing"
+
+def parse_natural (input):
+    # parse a natural string into an element of the abstract representation
+    global _NATURAL_GRAMMAR
+    if NATURAL_PARSER == "pratt":
+        return parse_natural_pratt(input)
+    if _NATURAL_GRAMMAR is None:
+        _NATURAL_GRAMMAR = natural_grammar()
+    result = _NATURAL_GRAMMAR.parseString(input)[0]
     return result    # the first element of the result is the expression
 
+
+##
+## PRATT PARSER
+##
+# a second backend for the natural syntax: one regular expression splits
+# the input into tokens, and expressions are parsed by precedence
+# climbing. It builds the same nodes as natural_grammar, but binary
+# operators get their usual precedence and associativity instead of the
+# right fold of pBASICEXPR (1 * 2 + 3 is (1 * 2) + 3, 5 - 2 - 1 is
+# (5 - 2) - 1)
+
+TOKEN_RE = re.compile(r"\s*(?:(\d+)|([A-Za-z_][A-Za-z0-9_]*)|(==|<>|<=|>=|[-+*<>=?:;,(){}\[\]]))")
+
+RESERVED_WORDS = ["let", "not", "fun", "and", "or", "true", "false",
+                  "if", "else", "while", "print", "for", "var", "def"]
+
+# binding power and node builder of each infix operator
+BINARY_OPERATORS = {
+    "*":   (70, lambda a, b: EPrimCall(oper_times, [a, b])),
+    "+":   (60, lambda a, b: EPrimCall(oper_plus, [a, b])),
+    "-":   (60, lambda a, b: EPrimCall(oper_minus, [a, b])),
+    "==":  (50, lambda a, b: EPrimCall(oper_equal, [a, b])),
+    "<>":  (50, lambda a, b: EPrimCall(oper_not_equal, [a, b])),
+    "<":   (50, lambda a, b: EPrimCall(oper_less_than, [a, b])),
+    "<=":  (50, lambda a, b: EPrimCall(oper_less_or_equal, [a, b])),
+    ">":   (50, lambda a, b: EPrimCall(oper_greater_than, [a, b])),
+    ">=":  (50, lambda a, b: EPrimCall(oper_greater_or_equal, [a, b])),
+    "and": (30, lambda a, b: EIf(a, b, EValue(VBoolean(False)))),
+    "or":  (20, lambda a, b: EIf(a, EValue(VBoolean(True)), b))
+}
+
+NOT_POWER = 40
+CONDITIONAL_POWER = 10
+CALL_POWER = 80
+
+
+class NaturalSyntaxError (Exception):
+    # a parse error, with the line where it was found
+
+    def __init__ (self, message, line):
+        Exception.__init__(self, "Parse error at line {}: {}".format(line, message))
+        self.line = line
+
+
+def tokenize (text):
+    # list of (kind, value, offset) tuples, kind being "int", "name", "op",
+    # closed by an "end" token
+    tokens = []
+    pos = 0
+    length = len(text)
+    while pos < length:
+        m = TOKEN_RE.match(text, pos)
+        if m is None:
+            if text[pos:].strip() == "":
+                break
+            offset = pos + len(text[pos:]) - len(text[pos:].lstrip())
+            raise NaturalSyntaxError("unexpected character " + repr(text[offset]),
+                                     text.count("\n", 0, offset) + 1)
+        if m.group(1) is not None:
+            tokens.append(("int", m.group(1), m.start(1)))
+        elif m.group(2) is not None:
+            tokens.append(("name", m.group(2), m.start(2)))
+        else:
+            tokens.append(("op", m.group(3), m.start(3)))
+        pos = m.end()
+    tokens.append(("end", None, length))
+    return tokens
+
+
+class NaturalParser (object):
+
+    def __init__ (self, text, tokens=None):
+        self._text = text
+        self._tokens = tokenize(text) if tokens is None else tokens
+        self._pos = 0
+
+    def line (self, token=None):
+        if token is None:
+            token = self._tokens[self._pos]
+        return self._text.count("\n", 0, token[2]) + 1
+
+    def error (self, message, token=None):
+        raise NaturalSyntaxError(message, self.line(token))
+
+    def peek (self, ahead=0):
+        return self._tokens[min(self._pos + ahead, len(self._tokens) - 1)]
+
+    def next (self):
+        token = self._tokens[self._pos]
+        if token[0] != "end":
+            self._pos += 1
+        return token
+
+    def at (self, value, ahead=0):
+        token = self.peek(ahead)
+        return token[0] in ("op", "name") and token[1] == value
+
+    def at_end (self):
+        return self.peek()[0] == "end"
+
+    def expect (self, value):
+        token = self.next()
+        if token[0] not in ("op", "name") or token[1] != value:
+            self.error("expected '{}' but found {}".format(value, describe_token(token)), token)
+        return token
+
+    def name (self):
+        token = self.next()
+        if token[0] != "name" or token[1] in RESERVED_WORDS:
+            self.error("expected a name but found " + describe_token(token), token)
+        return token[1]
+
+    def separated (self, item, close):
+        # item , item , ... close  (possibly empty)
+        items = []
+        if self.at(close):
+            self.next()
+            return items
+        items.append(item())
+        while self.at(","):
+            self.next()
+            items.append(item())
+        self.expect(close)
+        return items
+
+    ## expressions
+
+    def left_power (self, token):
+        if token[0] == "op" or token[0] == "name":
+            if token[1] in BINARY_OPERATORS:
+                return BINARY_OPERATORS[token[1]][0]
+            if token[1] == "?":
+                return CONDITIONAL_POWER
+            if token[1] == "(":
+                return CALL_POWER
+        return 0
+
+    def expression (self, power=0):
+        left = self.prefix(self.next())
+        while True:
+            token = self.peek()
+            token_power = self.left_power(token)
+            if token_power <= power:
+                return left
+            self.next()
+            left = self.infix(token, left)
+
+    def prefix (self, token):
+        (kind, value, _) = token
+        if kind == "int":
+            return EValue(VInteger(int(value)))
+        if kind == "op":
+            if value == "-" and self.peek()[0] == "int":
+                return EValue(VInteger(-int(self.next()[1])))
+            if value == "(":
+                e = self.expression()
+                self.expect(")")
+                return e
+            if value == "[":
+                return EArray(self.separated(self.expression, "]"))
+            if value == "{":
+                return ERecord(self.separated(self.entry, "}"))
+        if kind == "name":
+            if value == "true" or value == "false":
+                return EValue(VBoolean(value == "true"))
+            if value == "not":
+                return EPrimCall(oper_not, [self.expression(NOT_POWER)])
+            if value == "let":
+                self.expect("(")
+                bindings = self.separated(self.binding, ")")
+                body = self.expression()
+                return ECall(EFunction([b[0] for b in bindings], body), [b[1] for b in bindings])
+            if value == "fun":
+                name = None
+                if not self.at("("):
+                    name = self.name()
+                self.expect("(")
+                params = self.separated(self.name, ")")
+                body = self.block()
+                if name is None:
+                    return EFunction(params, body)
+                return EFunction(params, body, name=name)
+            if value not in RESERVED_WORDS:
+                return EId(value)
+        self.error("unexpected " + describe_token(token), token)
+
+    def infix (self, token, left):
+        value = token[1]
+        if value in BINARY_OPERATORS:
+            (power, build) = BINARY_OPERATORS[value]
+            return build(left, self.expression(power))
+        if value == "?":
+            e2 = self.expression()
+            self.expect(":")
+            # right associative: a ? b : c ? d : e is a ? b : (c ? d : e)
+            e3 = self.expression(CONDITIONAL_POWER - 1)
+            return EIf(left, e2, e3)
+        # value == "("
+        return ECall(left, self.separated(self.expression, ")"))
+
+    def binding (self):
+        name = self.name()
+        self.expect("=")
+        return (name, self.expression())
+
+    def entry (self):
+        name = self.name()
+        self.expect(":")
+        return (name, self.expression())
+
+    ## statements
+
+    def declaration (self):
+        if self.at("def"):
+            return self.definition()
+        return self.variable()
+
+    def definition (self):
+        # def NAME ( params ) block
+        self.expect("def")
+        name = self.name()
+        self.expect("(")
+        params = self.separated(self.name, ")")
+        return (name, EFunction(params, self.block(), name=name))
+
+    def variable (self):
+        self.expect("var")
+        name = self.name()
+        self.expect("=")
+        e = self.expression()
+        self.expect(";")
+        return (name, e)
+
+    def block (self):
+        self.expect("{")
+        decls = []
+        while self.at("var") or self.at("def"):
+            decls.append(self.declaration())
+        stmts = []
+        while not self.at("}"):
+            if self.at_end():
+                self.error("unterminated block")
+            stmts.append(self.statement())
+        self.next()
+        return mkBlock(decls, stmts)
+
+    def statement (self):
+        token = self.peek()
+        if token[0] == "name":
+            value = token[1]
+            if value == "if":
+                self.next()
+                cond = self.expression()
+                s1 = self.statement()
+                if self.at("else"):
+                    self.next()
+                    return EIf(cond, s1, self.statement())
+                return EIf(cond, s1, EValue(VBoolean(True)))
+            if value == "while":
+                self.next()
+                cond = self.expression()
+                return EWhile(cond, self.statement())
+            if value == "print":
+                self.next()
+                e = self.expression()
+                self.expect(";")
+                return EPrimCall(oper_print, [e])
+            if value == "for":
+                self.next()
+                self.expect("(")
+                init = [self.variable()] if self.at("var") else []
+                cond = self.expression()
+                self.expect(";")
+                (name, e) = self.variable()
+                self.expect(")")
+                return EFor(init, cond, EPrimCall(oper_update, [EId(name), e]), self.statement())
+            if value not in RESERVED_WORDS:
+                if self.at("[", 1):
+                    return self.update_array(token)
+                if self.at("{", 1) and self.peek(2)[0] == "name" and self.at("}", 3):
+                    return self.update_record(token)
+        elif self.at("{") and not (self.peek(1)[0] == "name" and self.at(":", 2)):
+            return self.block()
+        e = self.expression()
+        self.expect(";")
+        return EPrimCall(oper_print, [e])
+
+    def update_array (self, token):
+        self.next()
+        self.expect("[")
+        index = self.expression()
+        self.expect("]")
+        self.expect("=")
+        e = self.expression()
+        self.expect(";")
+        return EPrimCall(oper_update_array, [EId(token[1]), index, e])
+
+    def update_record (self, token):
+        self.next()
+        self.expect("{")
+        field = self.name()
+        self.expect("}")
+        self.expect("=")
+        e = self.expression()
+        self.expect(";")
+        return EPrimCall(oper_update_array, [EId(token[1]), EString(field), e])
+
+    def top (self):
+        # a declaration or a statement, as the pTOP rule of natural_grammar
+        if self.at("var") or self.at("def"):
+            return {"result":"declaration", "decl":self.declaration()}
+        return {"result":"statement", "stmt":self.statement()}
+
+    def program (self):
+        # every top-level declaration and statement up to the end of input
+        items = []
+        while not self.at_end():
+            items.append(self.top())
+        return items
+
+
+def describe_token (token):
+    if token[0] == "end":
+        return "end of input"
+    return "'{}'".format(token[1])
+
+def parse_natural_pratt (input):
+    # parse a natural string with the Pratt parser
+    return NaturalParser(input).top()
+
+_NATURAL_PROGRAM_GRAMMAR = None
+
+def parse_program (input):
+    # parse a whole source text into the list of its top-level
+    # declarations and statements, in order
+    #
+    # pyparsing parses the whole text in one pass; under ZeroOrMore a
+    # failing item only ends the repetition, so on an error that item is
+    # parsed again on its own, to report the line where it really fails
+    global _NATURAL_GRAMMAR, _NATURAL_PROGRAM_GRAMMAR
+    if NATURAL_PARSER == "pratt":
+        return NaturalParser(input).program()
+    if _NATURAL_PROGRAM_GRAMMAR is None:
+        if _NATURAL_GRAMMAR is None:
+            _NATURAL_GRAMMAR = natural_grammar()
+        # nothing before the end of a top-level item is parsed again:
+        # clearing the packrat cache there keeps it from filling up, and
+        # evicting an entry on every new one, on long programs
+        pITEM = _NATURAL_GRAMMAR.copy().addParseAction(lambda result: ParserElement.resetCache())
+        _NATURAL_PROGRAM_GRAMMAR = ZeroOrMore(pITEM) + StringEnd()
+    try:
+        return list(_NATURAL_PROGRAM_GRAMMAR.parseString(input))
+    except ParseBaseException as e:
+        pos = e.loc
+    try:
+        _NATURAL_GRAMMAR.parseString(input[pos:])
+        loc = pos
+    except ParseBaseException as e:
+        loc = pos + e.loc
+    # reported as by the Pratt parser: the token pyparsing stopped at,
+    # rather than the grammar it expected there
+    m = TOKEN_RE.match(input, loc)
+    if m is not None:
+        (found, loc) = ("'{}'".format(m.group(m.lastindex)), m.start(m.lastindex))
+    elif input[loc:].strip():
+        loc += len(input[loc:]) - len(input[loc:].lstrip())
+        found = "character " + repr(input[loc])
+    else:
+        found = "end of input"
+    raise NaturalSyntaxError("unexpected " + found, input.count("\n", 0, loc) + 1)
+
+
+## differential check of the two backends
+
+# statements on which the right fold of natural_grammar and the
+# precedence of the Pratt parser agree, so both must build the same tree
+NATURAL_CORPUS = [
+    "print 1;",
+    "print -5;",
+    "print x;",
+    "print 1 + 2;",
+    "print 1 + -5;",
+    "print x * 3;",
+    "print 7 - 2;",
+    "print (1 + 2) * 3;",
+    "print 2 * (3 + 4);",
+    "print ((x * 2) + 1) - y;",
+    "print x == 1;",
+    "print x <> y;",
+    "print a <= b;",
+    "print a >= b;",
+    "print a < b;",
+    "print a > b;",
+    "print (x + 1) == (y * 2);",
+    "print true and false;",
+    "print true or x;",
+    "print x ? 1 : 2;",
+    "print (a < b) ? a : b;",
+    "print not true;",
+    "print f(1, 2);",
+    "print f(x + 1);",
+    "print [ 1, 2, 3 ];",
+    "print [ x, (y + 1) * 2 ];",
+    "print { a: 1, b: x };",
+    "print let (x = 1, y = 2) x + y;",
+    "var x = 10;",
+    "var y = (x + 1) * 2;",
+    "var f = g(x, 2);",
+    "x[0] = 5;",
+    "r{a} = 3;",
+    "x + 1;",
+    "if x print 1; else print 2;",
+    "if x == 1 print 1;",
+    "while x < 3 print x;",
+    "for (var i = 0; i < 3; var i = i + 1;) print i;",
+    "for (i < 3; var i = i + 1;) print i;",
+    "for (var i = 0; i < 3; var i = i + 1;) { print i; }",
+    "{ var y = 1; print y; }",
+    "if x { print 1; } else { print 2; }",
+    "while x < 3 { print x; x; }",
+    "var g = fun (x) { var y = x; print y + 1; };",
+    "var h = fun loop (n) { if n > 0 loop(n - 1); };",
+    "def main () { var x = 1; print x; }",
+    "def add (a, b) { print a + b; }"
+]
+
+def same_tree (a, b):
+    # structural equality of parse results: nodes of the same class with
+    # equal fields, lists and ParseResults alike, primitives by identity
+    if isinstance(a, (list, tuple, ParseResults)):
+        if not isinstance(b, (list, tuple, ParseResults)) or len(a) != len(b):
+            return False
+        return all(same_tree(x, y) for (x, y) in zip(a, b))
+    if isinstance(a, dict):
+        if not isinstance(b, dict) or sorted(a.keys()) != sorted(b.keys()):
+            return False
+        return all(same_tree(a[k], b[k]) for k in a)
+    if isinstance(a, (Exp, Value)):
+        return type(a) is type(b) and same_tree(vars(a), vars(b))
+    return a == b
+
+def compare_backends (corpus=None, repeat=20):
+    # parse every statement of corpus with both backends; returns the
+    # statements whose trees differ, and the throughput of each backend
+    # in statements per second
+    if corpus is None:
+        corpus = NATURAL_CORPUS
+    global _NATURAL_GRAMMAR
+    if _NATURAL_GRAMMAR is None:
+        _NATURAL_GRAMMAR = natural_grammar()
+    mismatches = []
+    for text in corpus:
+        expected = _NATURAL_GRAMMAR.parseString(text)[0]
+        actual = parse_natural_pratt(text)
+        if not same_tree(expected, actual):
+            mismatches.append(text)
+    timings = []
+    for parse in [lambda text: _NATURAL_GRAMMAR.parseString(text)[0], parse_natural_pratt]:
+        start = time.time()
+        for i in range(repeat):
+            for text in corpus:
+                parse(text)
+        timings.append(time.time() - start)
+    count = repeat * len(corpus)
+    return (mismatches, {"pyparsing": count / timings[0], "pratt": count / timings[1]})
+
+
+##
+## AST CACHE
+##
+# parsed programs can be kept on disk, keyed by a hash of their source
+# text, of the parser backend and of the source of this file, so that
+# running the same file again skips parsing, and any change to the
+# classes or the parsers invalidates the cached trees. A tree is stored
+# as a marshal'ed table of nodes, children before their parents, with
+# primitives referred to by their name in PRIMITIVES.
+
+# directory of the cache, from HOMEWORK7_AST_CACHE; None, the default,
+# disables it
+AST_CACHE_DIR = os.environ.get("HOMEWORK7_AST_CACHE") or None
+
+# directory used by execute(..., cache=True) when AST_CACHE_DIR is None
+DEFAULT_AST_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "homework7")
+
+
+class CacheError (Exception):
+    # a tree that cannot be stored in the cache
+    pass
+
+
+AST_CLASSES = dict((cls.__name__, cls) for cls in [
+    EValue, EPrimCall, EIf, EId, ECall, EFunction, EArray, ERecord, EString,
+    EFor, ERefCell, EDo, EWhile, ELet, VInteger, VBoolean, VNone, VString])
+
+PRIMITIVE_NAMES = dict((prim, name) for (name, prim) in PRIMITIVES.items())
+
+def encode_tree (obj, table, seen):
+    # field value of a node table entry; nodes are appended to table,
+    # once each even when shared
+    if isinstance(obj, (Exp, Value)):
+        if id(obj) not in seen:
+            name = type(obj).__name__
+            if name not in AST_CLASSES:
+                raise CacheError("cannot serialize a {}".format(name))
+            fields = [ (k, encode_tree(v, table, seen)) for (k, v) in vars(obj).items() ]
+            table.append((name, fields))
+            seen[id(obj)] = len(table) - 1
+        return ("node", seen[id(obj)])
+    if isinstance(obj, (list, ParseResults)):
+        return ("list", [ encode_tree(x, table, seen) for x in obj ])
+    if isinstance(obj, tuple):
+        return ("tuple", [ encode_tree(x, table, seen) for x in obj ])
+    if isinstance(obj, dict):
+        return ("dict", [ (k, encode_tree(v, table, seen)) for (k, v) in obj.items() ])
+    if callable(obj):
+        if obj not in PRIMITIVE_NAMES:
+            raise CacheError("{} is not a registered primitive".format(obj))
+        return ("prim", PRIMITIVE_NAMES[obj])
+    return ("const", obj)
+
+def decode_tree (field, nodes):
+    (kind, value) = field
+    if kind == "node":
+        return nodes[value]
+    if kind == "list":
+        return [ decode_tree(x, nodes) for x in value ]
+    if kind == "tuple":
+        return tuple([ decode_tree(x, nodes) for x in value ])
+    if kind == "dict":
+        return dict((k, decode_tree(v, nodes)) for (k, v) in value)
+    if kind == "prim":
+        return PRIMITIVES[value]
+    return value
+
+def dump_tree (tree):
+    table = []
+    root = encode_tree(tree, table, {})
+    return marshal.dumps((table, root))
+
+def load_tree (data):
+    (table, root) = marshal.loads(data)
+    nodes = []
+    for (name, fields) in table:
+        cls = AST_CLASSES[name]
+        node = cls.__new__(cls)
+        for (k, v) in fields:
+            setattr(node, k, decode_tree(v, nodes))
+        nodes.append(node)
+    return decode_tree(root, nodes)
+
+_INTERPRETER_DIGEST = None
+
+def interpreter_digest ():
+    # hash of the source of this file, or None when it cannot be read
+    global _INTERPRETER_DIGEST
+    if _INTERPRETER_DIGEST is None:
+        try:
+            f = open(os.path.splitext(os.path.abspath(__file__))[0] + ".py", "rb")
+            try:
+                _INTERPRETER_DIGEST = hashlib.sha256(f.read()).hexdigest()
+            finally:
+                f.close()
+        except IOError:
+            return None
+    return _INTERPRETER_DIGEST
+
+def ast_cache_path (source, directory=None):
+    key = hashlib.sha256("\0".join([interpreter_digest(), sys.version, NATURAL_PARSER, source]))
+    return os.path.join(directory or AST_CACHE_DIR, key.hexdigest() + ".ast")
+
+def parse_program_cached (source, directory=None):
+    # parse_program, reusing the tree cached for the same source text in
+    # directory, AST_CACHE_DIR by default
+    directory = directory or AST_CACHE_DIR
+    if directory is None or interpreter_digest() is None:
+        return parse_program(source)
+    path = ast_cache_path(source, directory)
+    if os.path.exists(path):
+        try:
+            f = open(path, "rb")
+            try:
+                return load_tree(f.read())
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError, KeyError):
+            pass    # unreadable entry: parse again and overwrite it
+    program = parse_program(source)
+    try:
+        data = dump_tree(program)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # write under a temporary name so that concurrent runs never
+        # read a partial entry
+        temp = "{}.{}.tmp".format(path, os.getpid())
+        f = open(temp, "wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(temp, path)
+    except (IOError, OSError, CacheError):
+        pass    # the cache is only an optimization
+    return program
+
+
 ## natural shell helper functions
 
 def append_left(result):
+    # builds a new node rather than updating result[1]: with packrat
+    # parsing, result[1] can be a cached node shared with other parses
     if(len(result) == 2):
         if type(result[1]) == EPrimCall:
-            result[1]._exps.append(result[0])
-            result[1]._exps.reverse()
-            return result[1]
+            return EPrimCall(result[1]._prim, [result[0]] + result[1]._exps)
         if type(result[1]) == EIf:
-            result[1]._cond = result[0] 
-            return result[1]
+            return EIf(result[0], result[1]._then, result[1]._else)
     return result[0]
 
 def update_environment(variable, env):
@@ -831,26 +1491,38 @@ def shell ():
             traceback.print_exc()
 
 
-def execute(filename):
+def execute(filename, call_main=True, cache=None):
+    # parse the whole file, then evaluate its declarations and statements
+    # in order; with call_main, finally call main() if the file defines
+    # it, as the sample programs expect (def main () { ... } only
+    # declares it)
+    #
+    # cache=True keeps the parsed program in the AST cache, in
+    # AST_CACHE_DIR or DEFAULT_AST_CACHE_DIR, and cache=False always
+    # parses the file afresh; by default, the cache is only used when
+    # HOMEWORK7_AST_CACHE sets AST_CACHE_DIR
     print 'Executing ' + str(filename)
     f = open(str(filename), 'r')
+    source = f.read()
+    f.close()
+    try:
+        if cache is None:
+            program = parse_program_cached(source)
+        elif cache:
+            program = parse_program_cached(source, AST_CACHE_DIR or DEFAULT_AST_CACHE_DIR)
+        else:
+            program = parse_program(source)
+    except NaturalSyntaxError as e:
+        print "Exception: {}".format(e)
+        return
     env = initial_env()
-    for line in f.readlines():
-        line = line
-        try:
-            result = parse_natural(line)
-
+    try:
+        for result in program:
             if result["result"] == "statement":
                 stmt = result["stmt"]
                 # print "Abstract representation:", exp
                 v = stmt.eval(env)
 
-            elif result["result"] == "abstract":
-                print result["stmt"]
-
-            elif result["result"] == "quit":
-                return
-
             elif result["result"] == "declaration":
                 (name,expr) = result["decl"]
                 v = expr.eval(env)
@@ -861,8 +1533,11 @@ def execute(filename):
                 var = tuple([name, VRefCell(v)])
 
                 env = update_environment(var, env)
-        except Exception as e:
-            continue
+
+        if call_main and any(id == "main" for (id, v) in env):
+            ECall(EId("main"), []).eval(env)
+    except Exception as e:
+        print "Exception: {}".format(e)
 
         
 # increase stack size to let us call recursive functions quasi comfortably
@@ -0,0 +1,260 @@
+############################################################
+# Tests of the inference engines of distributions
+#
+# programs are run through parse_imp, as the shell runs them; queries
+# are seeded so that every sampling engine is reproducible
+#
+# run with:  python -m unittest test_distributions
+#
+
+import os, sys, shutil, tempfile, unittest
+from StringIO import StringIO
+
+import numpy as np
+
+import distributions
+
+
+def run (text, env=None):
+    # environment after evaluating the lines of text as the shell does,
+    # with whatever they print thrown away
+    if env is None:
+        env = distributions.initial_env_imp()
+    saved = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        for line in text.strip().splitlines():
+            result = distributions.parse_imp(line)
+            if result["result"] == "statement":
+                result["stmt"].eval(env)
+            elif result["result"] == "declaration":
+                (name, expr) = result["decl"]
+                env.insert(0, (name, distributions.VRefCell(expr.eval(env))))
+    finally:
+        sys.stdout = saved
+    return env
+
+def evaluate (env, text):
+    # value of the expression text in env
+    return run("var it = {};".format(text), env)[0][1].content
+
+def printed (env, text):
+    # lines printed by the statement text in env
+    saved = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        distributions.parse_imp(text)["stmt"].eval(env)
+        return sys.stdout.getvalue().splitlines()
+    finally:
+        sys.stdout = saved
+
+
+class TestEnumeration (unittest.TestCase):
+    # a is observed through a flip that is true 90% of the time when a
+    # is: P(a) = 0.9 under the posterior, and b is independent of it
+
+    FLIPS = "defquery q [(a -> (sample (flip 50))) (b -> (sample (flip 50)))] (do (observe (flip (if a 90 10)) true) (if a b false));"
+
+    def test_exact (self):
+        env = run(self.FLIPS)
+        d = evaluate(env, '(doquery q (engine -> "enumerate"))')
+        self.assertEqual(d.distribution, "binomial")
+        self.assertAlmostEqual(d.mean(), 0.45)
+
+    def test_weighted (self):
+        env = run(self.FLIPS)
+        d = evaluate(env, '(doquery q (engine -> "weighted") (particles -> 20000) (seed -> 1))')
+        self.assertAlmostEqual(d.mean(), 0.45, delta=0.02)
+
+
+class TestConjugate (unittest.TestCase):
+
+    def test_normal (self):
+        # prior N(0, 1), one observation 2 with noise 1: N(1, 1/sqrt(2))
+        env = run("defquery q [(x -> (sample (normal 0 1)))] (do (observe (normal x 1) 2) x);")
+        d = evaluate(env, "(doquery q)")
+        self.assertEqual(d.distribution, "normal")
+        (mu, sigma) = d.params
+        self.assertAlmostEqual(mu, 1.0)
+        self.assertAlmostEqual(sigma, np.sqrt(0.5))
+        sampled = evaluate(env, '(doquery q (engine -> "weighted") (particles -> 20000) (seed -> 1))')
+        self.assertAlmostEqual(sampled.mean(), mu, delta=0.03)
+        self.assertAlmostEqual(sampled.std(), sigma, delta=0.03)
+
+
+class TestSMC (unittest.TestCase):
+    # random walk x(t) = x(t-1) + N(0, 1) observed as N(x(t), 1) = 2t:
+    # the Kalman filter gives the exact posterior of x(T) and evidence
+
+    STEPS = 20
+
+    def kalman (self):
+        (m, p, log_evidence) = (0.0, 0.0, 0.0)
+        for t in range(1, self.STEPS + 1):
+            p += 1
+            (y, s) = (2.0 * t, p + 1)
+            log_evidence += -0.5 * (np.log(2 * np.pi * s) + (y - m)**2 / s)
+            (m, p) = (m + p / s * (y - m), p - p * p / s)
+        return (m, np.sqrt(p), log_evidence)
+
+    def test_random_walk (self):
+        env = run("""
+var out = 0;
+procedure track () { var x = 0; var t = 1; var o = 0; while (< t %d) { x <- (+ x (sample (normal 0 1))); o <- (observe (normal x 1) (* 2 t)); t <- (+ t 1); } out <- x; }
+defquery hmm [(d -> (track))] out;
+""" % (self.STEPS + 1))
+        d = evaluate(env, '(doquery hmm (engine -> "smc") (particles -> 5000) (seed -> 1))')
+        (mean, std, log_evidence) = self.kalman()
+        self.assertAlmostEqual(d.mean(), mean, delta=0.1)
+        self.assertAlmostEqual(d.std(), std, delta=0.1)
+        self.assertAlmostEqual(d.log_evidence, log_evidence, delta=0.5)
+
+
+class TestWorkers (unittest.TestCase):
+    # every run and block of particles draws from its own stream: the
+    # workers give the samples of a single process, bit for bit
+
+    def assertSameRuns (self, options):
+        env = run("defquery q [(x -> (sample (normal 0 1))) (y -> (sample (flip 30)))] (do (observe (normal x 1) 2) (if y (+ x 10) x));")
+        (one, two) = [ evaluate(env, '(doquery q (engine -> "weighted") (seed -> 5) (workers -> {}) {})'.format(w, options))
+                       for w in (1, 3) ]
+        self.assertTrue(np.array_equal(one.samples(), two.samples()))
+        self.assertTrue(np.array_equal(one.weights, two.weights))
+
+    def test_runs (self):
+        self.assertSameRuns("(runs -> 500)")
+
+    def test_particles (self):
+        saved = distributions.PARTICLE_BLOCK
+        distributions.PARTICLE_BLOCK = 1000
+        try:
+            self.assertSameRuns("(particles -> 5500)")
+        finally:
+            distributions.PARTICLE_BLOCK = saved
+
+
+class TestMaskedUpdates (unittest.TestCase):
+    # a write inside a conditional whose condition differs between
+    # particles only applies to the particles that take its branch
+
+    PICK = """
+var arr = (new-array 2);
+arr[0] <- 0;
+arr[1] <- 5;
+procedure pick (x) { if x { arr[0] <- 1; } else { arr[0] <- 2; } }
+defquery q [(x -> (sample (flip 50)))] (do (pick x) (with arr (index 0)));
+"""
+
+    def test_array_enumerate (self):
+        env = run(self.PICK)
+        self.assertAlmostEqual(evaluate(env, "(doquery q)").mean(), 1.5)
+
+    def test_array_particles (self):
+        env = run(self.PICK)
+        d = evaluate(env, '(doquery q (engine -> "weighted") (particles -> 4000) (seed -> 1))')
+        self.assertAlmostEqual(d.mean(), 1.5, delta=0.05)
+
+    def test_particle_index (self):
+        env = run(self.PICK + 'defquery r [(x -> (sample (flip 50)))] (with arr (index (if x 0 1)));')
+        self.assertAlmostEqual(evaluate(env, "(doquery r)").mean(), 2.5)
+
+    def test_scalar (self):
+        env = run("""
+var c = 0;
+procedure setc (x) { if x c <- 1; else c <- 2; }
+defquery q [(x -> (sample (flip 30)))] (do (setc x) c);
+""")
+        self.assertAlmostEqual(evaluate(env, "(doquery q)").mean(), 1.7)
+
+    def test_shell_refs_after_query (self):
+        # particles written to a ref of the shell do not outlive the query
+        env = run("""
+var c = 0;
+procedure setc (x) { if (< x 0) c <- 1; else c <- 2; }
+defquery q [(x -> (sample (normal 0 1)))] (do (setc x) c);
+defquery r [(y -> (sample (flip 50)))] (if y c 0);
+""")
+        d = evaluate(env, '(doquery q (engine -> "weighted") (particles -> 1000) (seed -> 1))')
+        self.assertAlmostEqual(d.mean(), 1.5, delta=0.05)
+        c = evaluate(env, "c")
+        self.assertIn(c.value, (1, 2))
+        self.assertAlmostEqual(evaluate(env, "(doquery r)").mean(), c.value / 2.0)
+
+    def test_particle_index_update (self):
+        env = run("""
+var arr = (new-array 2);
+arr[0] <- 0;
+arr[1] <- 0;
+procedure put (x) { arr[(if x 0 1)] <- 1; }
+defquery q [(x -> (sample (flip 30)))] (do (put x) (with arr (index 0)));
+""")
+        self.assertAlmostEqual(evaluate(env, "(doquery q)").mean(), 0.3)
+
+
+class TestAutoEngine (unittest.TestCase):
+
+    def test_sampling_fallback (self):
+        # new-array only takes a plain size: the enumeration pass fails,
+        # and auto samples the query one run at a time instead
+        env = run("""
+var n = 0;
+procedure size (x) { var a = (new-array (if x 1 2)); n <- (with a (length)); }
+defquery q [(x -> (sample (flip 50)))] (do (size x) n);
+""")
+        d = evaluate(env, "(doquery q (runs -> 2000) (seed -> 1))")
+        self.assertAlmostEqual(d.mean(), 1.5, delta=0.05)
+        self.assertRaises(TypeError, evaluate, env, '(doquery q (engine -> "enumerate"))')
+
+
+class TestSaveLoad (unittest.TestCase):
+    # a posterior saved to disk and memory-mapped back has the
+    # statistics of the one in memory
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown (self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip (self):
+        env = run("defquery q [(x -> (sample (normal 0 1)))] (if (< 0 (observe (normal x 1) 2)) x 0);")
+        d = evaluate(env, '(doquery q (engine -> "weighted") (particles -> 20000) (seed -> 1))')
+        path = distributions.save_distribution(d, os.path.join(self.directory, "post"))
+        loaded = distributions.load_distribution(path)
+        self.assertTrue(loaded.mapped())
+        self.assertAlmostEqual(loaded.mean(), d.mean())
+        self.assertAlmostEqual(loaded.std(), d.std())
+        for x in [-1.0, 0.5, 1.0, 2.5]:
+            self.assertAlmostEqual(loaded.cdf(x), d.cdf(x))
+        for q in [0.1, 0.5, 0.9]:
+            self.assertAlmostEqual(loaded.quantile(q), d.quantile(q), delta=1e-3)
+
+
+class TestMetropolisHastings (unittest.TestCase):
+
+    def test_impossible (self):
+        # as under the other engines, a query no run satisfies is an error
+        env = run("defquery q [(x -> (sample (uniform 0 1)))] (do (observe (uniform 0 1) 5) x);")
+        for engine in ["mh", "weighted", "smc"]:
+            with self.assertRaises(Exception) as caught:
+                evaluate(env, '(doquery q (engine -> "{}") (seed -> 1))'.format(engine))
+            self.assertIn("impossible", str(caught.exception))
+
+    def test_leaves_impossible_start (self):
+        # x is positive under the posterior, whatever the first trace drew
+        env = run("defquery q [(x -> (sample (normal 0 1)))] (do (observe (uniform 0 1) x) x);")
+        d = evaluate(env, '(doquery q (engine -> "mh") (burn -> 0) (seed -> 3))')
+        self.assertTrue((d.samples() >= 0).all())
+
+
+class TestStreaming (unittest.TestCase):
+
+    def test_limit (self):
+        # the limit alone streams the query, and cuts the last batch short
+        env = run("defquery q [(x -> (sample (normal 0 1)))] (+ x 0);")
+        lines = printed(env, "doquery q [(limit -> 2500) (seed -> 1)];")
+        self.assertEqual([ line.split()[0] for line in lines[:-1] ], ["1000", "2000", "2500"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,191 @@
+############################################################
+# Tests of the natural syntax of homework7
+#
+# both parser backends run on every test: they must build the same
+# trees wherever the right fold of natural_grammar and the precedence
+# of the Pratt parser agree, and differ, as recorded here, where they
+# do not
+#
+# run with:  python -m unittest test_homework7
+#
+
+import os, sys, shutil, tempfile, unittest
+from StringIO import StringIO
+
+import homework7
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+BACKENDS = ["pyparsing", "pratt"]
+
+
+def parse_with (backend, text):
+    saved = homework7.NATURAL_PARSER
+    homework7.NATURAL_PARSER = backend
+    try:
+        return homework7.parse_natural(text)
+    finally:
+        homework7.NATURAL_PARSER = saved
+
+def parse_program_with (backend, text):
+    saved = homework7.NATURAL_PARSER
+    homework7.NATURAL_PARSER = backend
+    try:
+        return homework7.parse_program(text)
+    finally:
+        homework7.NATURAL_PARSER = saved
+
+def run_with (backend, filename, call_main=True):
+    # lines printed by executing filename under backend, without the
+    # AST cache
+    saved = (homework7.NATURAL_PARSER, homework7.AST_CACHE_DIR, sys.stdout)
+    homework7.NATURAL_PARSER = backend
+    homework7.AST_CACHE_DIR = None
+    sys.stdout = StringIO()
+    try:
+        homework7.execute(os.path.join(HERE, filename), call_main)
+        return sys.stdout.getvalue().splitlines()
+    finally:
+        (homework7.NATURAL_PARSER, homework7.AST_CACHE_DIR, sys.stdout) = saved
+
+
+class TestCorpus (unittest.TestCase):
+
+    def test_same_trees (self):
+        for text in homework7.NATURAL_CORPUS:
+            (expected, actual) = [ parse_with(b, text) for b in BACKENDS ]
+            self.assertTrue(homework7.same_tree(expected, actual), text)
+
+    def test_compare_backends (self):
+        (mismatches, rates) = homework7.compare_backends(repeat=1)
+        self.assertEqual(mismatches, [])
+        self.assertEqual(sorted(rates), sorted(BACKENDS))
+
+
+class TestPrecedence (unittest.TestCase):
+    # pBASICEXPR folds binary operators to the right, whatever they are;
+    # the Pratt parser gives * precedence over + and -
+
+    def assertParsesAs (self, backend, text, reference):
+        self.assertTrue(homework7.same_tree(parse_with(backend, text), parse_with("pratt", reference)),
+                        "{} under {}".format(text, backend))
+
+    def test_times_then_plus (self):
+        self.assertParsesAs("pyparsing", "print x * 2 + 2;", "print x * (2 + 2);")
+        self.assertParsesAs("pratt", "print x * 2 + 2;", "print (x * 2) + 2;")
+
+    def test_two_products (self):
+        self.assertParsesAs("pyparsing", "print x * 2 + x * 2;", "print x * (2 + (x * 2));")
+        self.assertParsesAs("pratt", "print x * 2 + x * 2;", "print (x * 2) + (x * 2);")
+
+    def test_left_associative_minus (self):
+        self.assertParsesAs("pyparsing", "print 5 - 2 - 1;", "print 5 - (2 - 1);")
+        self.assertParsesAs("pratt", "print 5 - 2 - 1;", "print (5 - 2) - 1;")
+
+
+class TestSyntaxErrors (unittest.TestCase):
+    # errors are reported at the line of the statement that fails, not at
+    # the first line of the top-level item around it
+
+    def assertErrorLine (self, text, line):
+        for backend in BACKENDS:
+            try:
+                parse_program_with(backend, text)
+            except homework7.NaturalSyntaxError as e:
+                self.assertEqual(e.line, line, "{}: {}".format(backend, e))
+            else:
+                self.fail("{} parsed {!r}".format(backend, text))
+
+    def test_top_level (self):
+        self.assertErrorLine("var a = 1;\nprint a;\nprint a +;\nprint 3;\n", 3)
+
+    def test_inside_def (self):
+        self.assertErrorLine("var a = 1;\n\ndef main () {\n  var x = 1;\n  print x;\n  print x +;\n}\n", 6)
+
+    def test_unexpected_character (self):
+        self.assertErrorLine("var a = 1;\nprint a $ 2;\n", 2)
+
+    def test_programs (self):
+        text = "var a = 1;\nprint a + 2;\ndef main () { print a; }\n"
+        (expected, actual) = [ parse_program_with(b, text) for b in BACKENDS ]
+        self.assertEqual(len(expected), 3)
+        self.assertTrue(homework7.same_tree(expected, actual))
+
+
+class TestSampleArithmetic (unittest.TestCase):
+    # sample-arithmetic.pj prints, with x = 10:
+    #   x, x + 2, x * 2, x + 2 * 2, x * 2 + 2, (x - 2) + 2, (x + 2) * 2,
+    #   x * 2 + x * 2
+
+    def printed (self, backend):
+        return run_with(backend, "sample-arithmetic.pj")[-8:]
+
+    def test_pyparsing (self):
+        self.assertEqual(self.printed("pyparsing"), ["10", "12", "20", "14", "40", "10", "24", "220"])
+
+    def test_pratt (self):
+        self.assertEqual(self.printed("pratt"), ["10", "12", "20", "14", "22", "10", "24", "40"])
+
+    def test_without_main (self):
+        for backend in BACKENDS:
+            # main is declared but never called: nothing is printed
+            self.assertNotIn("10", run_with(backend, "sample-arithmetic.pj", call_main=False))
+
+    def test_divergence (self):
+        (fold, pratt) = [ self.printed(b) for b in BACKENDS ]
+        # x * 2 + 2
+        self.assertEqual((fold[4], pratt[4]), ("40", "22"))
+        # x * 2 + x * 2
+        self.assertEqual((fold[7], pratt[7]), ("220", "40"))
+        # every other statement agrees
+        self.assertEqual([ a for (i, a) in enumerate(fold) if i not in (4, 7) ],
+                         [ b for (i, b) in enumerate(pratt) if i not in (4, 7) ])
+
+
+class TestAstCache (unittest.TestCase):
+
+    def setUp (self):
+        self.saved = (homework7.AST_CACHE_DIR, homework7.DEFAULT_AST_CACHE_DIR)
+        self.directory = tempfile.mkdtemp()
+        homework7.AST_CACHE_DIR = self.directory
+
+    def tearDown (self):
+        shutil.rmtree(self.directory)
+        (homework7.AST_CACHE_DIR, homework7.DEFAULT_AST_CACHE_DIR) = self.saved
+
+    def test_off_by_default (self):
+        # without HOMEWORK7_AST_CACHE, execute only caches when asked to
+        homework7.AST_CACHE_DIR = None
+        homework7.DEFAULT_AST_CACHE_DIR = self.directory
+        saved = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            homework7.execute(os.path.join(HERE, "sample-arithmetic.pj"))
+            self.assertEqual(os.listdir(self.directory), [])
+            homework7.execute(os.path.join(HERE, "sample-arithmetic.pj"), cache=True)
+            self.assertEqual(len(os.listdir(self.directory)), 1)
+        finally:
+            sys.stdout = saved
+
+    def test_round_trip (self):
+        text = "var a = 1;\nprint a + 2;\ndef main () { print a; }\n"
+        parsed = homework7.parse_program_cached(text)
+        self.assertTrue(os.path.exists(homework7.ast_cache_path(text)))
+        self.assertTrue(homework7.same_tree(homework7.parse_program_cached(text), parsed))
+
+    def test_unserializable (self):
+        # a tree the cache cannot store is still returned, just not cached
+        text = "print 1;\n"
+        saved = homework7.dump_tree
+        def dump_tree (program):
+            raise homework7.CacheError("cannot serialize")
+        homework7.dump_tree = dump_tree
+        try:
+            self.assertEqual(len(homework7.parse_program_cached(text)), 1)
+        finally:
+            homework7.dump_tree = saved
+        self.assertEqual(os.listdir(homework7.AST_CACHE_DIR), [])
+
+
+if __name__ == "__main__":
+    unittest.main()